@@ -0,0 +1,202 @@
+"""
+Incrementally updated feature transformer outputs for the HalfKAv2_hm
+feature set, used to evaluate positions during search on the CPU.
+
+A move only changes a handful of features per perspective, so instead of
+running the feature transformer from scratch for every position the
+accumulator adds and subtracts the weight rows of the changed features,
+see https://www.chessprogramming.org/NNUE
+"""
+
+import chess
+import numpy
+import torch
+
+from halfka_v2_hm import KingBuckets, NUM_PLANES_REAL, NUM_SQ, halfka_idx
+
+
+def _changes(board, move):
+    """
+    The (square, piece type, color) of the pieces removed from and added to
+    `board` by `move`, the moving piece first, without pushing it.
+    """
+    from_square = move.from_square
+    to_square = move.to_square
+    piece_type = board.piece_type_at(from_square)
+    color = board.turn
+    removed = [(from_square, piece_type, color)]
+    file_distance = chess.square_file(to_square) - chess.square_file(from_square)
+
+    if piece_type == chess.KING and abs(file_distance) > 1:
+        # Castling, standard chess only
+        rank_start = to_square & ~7
+        rook_from, rook_to = (7, 5) if file_distance > 0 else (0, 3)
+        removed.append((rank_start + rook_from, chess.ROOK, color))
+        return removed, [
+            (to_square, chess.KING, color),
+            (rank_start + rook_to, chess.ROOK, color),
+        ]
+
+    if piece_type == chess.PAWN and file_distance and to_square == board.ep_square:
+        captured_square = (from_square & ~7) + (to_square & 7)
+        removed.append((captured_square, chess.PAWN, not color))
+    else:
+        captured = board.piece_type_at(to_square)
+        if captured is not None:
+            removed.append((to_square, captured, not color))
+
+    if move.promotion is not None:
+        piece_type = move.promotion
+    return removed, [(to_square, piece_type, color)]
+
+
+class Accumulator:
+    """
+    Feature transformer outputs of both perspectives, kept on a stack
+    that follows the moves pushed and popped on the board.
+
+    Features of a perspective are relative to its own king, so when that
+    king moves its half of the accumulator is refreshed from scratch.
+    """
+
+    def __init__(self, model, board):
+        self.model = model
+        self.weight = model.input.weight.detach().cpu().numpy()
+        self.bias = model.input.bias.detach().cpu().numpy()
+        self.stack = [
+            (self.refresh(board, chess.WHITE), self.refresh(board, chess.BLACK))
+        ]
+
+    def refresh(self, board, perspective):
+        ksq = board.king(perspective)
+        indices = [
+            halfka_idx(perspective, ksq, sq, piece)
+            for sq, piece in board.piece_map().items()
+        ]
+        return self.bias + self.weight[indices].sum(axis=0)
+
+    def push(self, board, move):
+        """
+        Push `move` on `board` and update the accumulator to match.
+        """
+        removed, added = _changes(board, move)
+        board.push(move)
+        self.stack.append(
+            tuple(
+                self.update(board, perspective, accumulation, removed, added)
+                for perspective, accumulation in zip(
+                    (chess.WHITE, chess.BLACK), self.stack[-1]
+                )
+            )
+        )
+
+    def update(self, board, perspective, accumulation, removed, added):
+        _, piece_type, color = removed[0]
+        if piece_type == chess.KING and color == perspective:
+            return self.refresh(board, perspective)
+
+        ksq = board.king(perspective)
+        removed_rows = self.weight[
+            [
+                halfka_idx(perspective, ksq, sq, chess.Piece(piece_type, color))
+                for sq, piece_type, color in removed
+            ]
+        ]
+        added_rows = self.weight[
+            [
+                halfka_idx(perspective, ksq, sq, chess.Piece(piece_type, color))
+                for sq, piece_type, color in added
+            ]
+        ]
+        return accumulation - removed_rows.sum(axis=0) + added_rows.sum(axis=0)
+
+    def children(self, board, moves):
+        """
+        The snapshots of the positions after each of `moves` on `board`, as
+        the arguments of `evaluate_batch`. They are computed together from
+        the current accumulator, with one gather of the weight rows of the
+        features that the moves change, rather than by pushing each move.
+        """
+        n = len(moves)
+        # Up to two pieces are added and two removed by a move, padded with
+        # a sign of 0
+        changes = numpy.zeros((n, 4, 4), numpy.int64)
+        buckets = []
+        king_moves = []
+        occupied = chess.popcount(board.occupied)
+        for i, move in enumerate(moves):
+            removed, added = _changes(board, move)
+            for j, (sq, piece_type, color) in enumerate(added):
+                changes[i, j] = (sq, piece_type, color, 1)
+            for j, (sq, piece_type, color) in enumerate(removed):
+                changes[i, 2 + j] = (sq, piece_type, color, -1)
+            buckets.append((occupied - 1 - (len(removed) > len(added))) // 4)
+            if removed[0][1] == chess.KING:
+                king_moves.append(i)
+        squares, piece_types, colors, signs = changes.transpose(2, 0, 1)
+
+        accumulations = []
+        for perspective, accumulation in zip(
+            (chess.WHITE, chess.BLACK), self.stack[-1]
+        ):
+            # halfka_idx for every change at once
+            ksq = board.king(perspective)
+            flip = (7 * (ksq % 8 < 4)) ^ (56 * (not perspective))
+            base = KingBuckets[flip ^ ksq] * NUM_PLANES_REAL
+            plane = (piece_types - 1) * 2 + (colors != perspective)
+            plane = numpy.minimum(plane, 10)
+            indices = numpy.where(
+                signs != 0, (squares ^ flip) + plane * NUM_SQ + base, 0
+            )
+
+            rows = self.weight[indices.ravel()].reshape(n, 4, -1)
+            weights = signs.astype(numpy.float32)[:, numpy.newaxis, :]
+            accumulations.append(accumulation + numpy.matmul(weights, rows)[:, 0])
+
+        # The perspective of a king that moves is refreshed from scratch
+        for i in king_moves:
+            board.push(moves[i])
+            p = 0 if board.turn == chess.BLACK else 1
+            accumulations[p][i] = self.refresh(board, not board.turn)
+            board.pop()
+
+        turns = [not board.turn] * n
+        return accumulations[0], accumulations[1], turns, buckets
+
+    def pop(self, board):
+        board.pop()
+        self.stack.pop()
+
+    def snapshot(self, board):
+        """
+        Everything needed to evaluate the current position later on,
+        possibly in a batch with other positions.
+        """
+        white, black = self.stack[-1]
+        bucket = (chess.popcount(board.occupied) - 1) // 4
+        return white, black, board.turn == chess.WHITE, bucket
+
+    def evaluate(self, snapshots):
+        """
+        Evaluate a list of snapshots in a single forward pass through the
+        rest of the network. Scores are in pawns from the perspective of
+        the side to move.
+        """
+        whites, blacks, turns, buckets = zip(*snapshots)
+        return self.evaluate_batch(
+            numpy.stack(whites), numpy.stack(blacks), turns, buckets
+        )
+
+    @torch.no_grad()
+    def evaluate_batch(self, whites, blacks, turns, buckets):
+        """
+        Like `evaluate`, for the accumulations of both perspectives as
+        (batch, outputs) arrays, and lists of the other fields.
+        """
+        wp = torch.from_numpy(whites)
+        bp = torch.from_numpy(blacks)
+        us = torch.tensor(turns, dtype=torch.float32).unsqueeze(dim=1)
+        them = 1.0 - us
+        indices = torch.tensor(buckets, dtype=torch.long)
+        x = self.model.forward_accumulators(us, them, wp, bp, indices, indices)
+        return (x.flatten() * 600.0 / 208.0).tolist()
@@ -1,22 +1,57 @@
+import accumulator
+import eval_cache
+import eval_session
 import features
+import move_ordering
 import nnue_dataset
+import quantized_nnue
 import remote
+import search_stats
 import serialize
+import transposition
 
 import argparse
 import chess
 import chess.pgn
+import concurrent.futures
 import json
+import multiprocessing
+import os
+import threading
+import time
+import weakref
+import torch
 
 FEATURE_SET = features.get_feature_set_from_name("HalfKAv2_hm")
 MAX_PLY = 128
 MATE = 99999
 MIN_MATE_SCORE = MATE - MAX_PLY
 
+# Half-width of the initial aspiration window of iterative deepening, in
+# pawns like the scores returned by eval_positions
+ASPIRATION_WINDOW = 0.5
+
+# Captures that cannot bring the score within this many pawns of alpha,
+# even when winning the captured piece outright, are skipped by quiescence
+DELTA_MARGIN = 2.0
+
 # chess.PieceType are integers for PNBRQK, 1-7
 # Create a "1-indexed" array with the piece value
 PIECE_VALUES = [None, 100, 300, 300, 500, 900, 0]
 
+# Transposition table and evaluation cache of each evaluator, a model or
+# an inference server, shared by the searches that evaluate with it so
+# that results carry over between calls, see search_tables
+_search_tables = weakref.WeakKeyDictionary()
+_search_tables_lock = threading.Lock()
+
+# Net of a worker process of the parallel analysis, see init_worker
+_worker_model = None
+
+# Environment variable selecting the device of entry points that have no
+# command line, like the predict.py and service.py servers
+DEVICE_ENV = "VIDA_DEVICE"
+
 
 # Copied and adapted from python-chess-engine-extensions
 # https://github.com/Mk-Chan/python-chess-engine-extensions/blob/master/search/alphabeta.py
@@ -30,64 +65,684 @@ def sort_moves(board, move):
     return order
 
 
-def next_fen(starting, move):
-    board = chess.Board(starting)
-    board.push(move)
-    return board.fen()
+class SearchTimeout(Exception):
+    pass
+
+
+class SearchLimits:
+    """
+    Wall-clock and node budget of an iterative deepening search. Searches
+    call `visit` as they go, which raises SearchTimeout once the budget
+    is exhausted or the search was stopped.
+    """
+
+    def __init__(self, movetime=None, max_nodes=None):
+        self.deadline = None if movetime is None else time.monotonic() + movetime
+        self.max_nodes = max_nodes
+        self.nodes = 0
+        self.stopped = False
+
+    def stop(self):
+        """
+        End the search, typically from another thread, as if its budget
+        had run out.
+        """
+        self.stopped = True
+
+    def visit(self, count=1, budget=True):
+        """
+        Count `count` nodes. Unless `budget` is False, which only checks
+        whether the search was stopped, also check the budget.
+        """
+        self.nodes += count
+        if self.stopped:
+            raise SearchTimeout()
+        if not budget:
+            return
+        if self.max_nodes is not None and self.nodes > self.max_nodes:
+            raise SearchTimeout()
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise SearchTimeout()
 
 
 # Negamax implementation from https://www.chessprogramming.org/Alpha-Beta
 # with some help from python-chess-engine-extensions
 # https://github.com/Mk-Chan/python-chess-engine-extensions/blob/master/search/alphabeta.py
 #
-# TODO
-# * Add quiescence search https://www.chessprogramming.org/Quiescence_Search
+# Moves are made and unmade on a single board and the PV is collected in a
+# triangular PV table, https://www.chessprogramming.org/Triangular_PV-Table
 #
-def alpha_beta(fen, depth, alpha, beta, evaluate, ply=0):
-    if depth == 0 or ply >= MAX_PLY:
-        return evaluate(fen), []
+# Leaves are resolved with a capture-only quiescence search,
+# https://www.chessprogramming.org/Quiescence_Search
+#
+# `evaluate` takes a list of FENs and returns their evaluations from white's
+# perspective, so that all children of a node can be scored in a single
+# batch. Depth 1 nodes and quiescence nodes score all of their children
+# this way before searching them. With `pack`, `evaluate` is given
+# `pack(board)` of each position instead of its FEN.
+#
+class Search:
+    def __init__(
+        self,
+        board,
+        evaluate,
+        tt=None,
+        limits=None,
+        accumulator=None,
+        eval_cache=None,
+        stats=None,
+        pack=None,
+    ):
+        self.board = board
+        self.evaluate = evaluate
+        self.pack = pack
+        self.tt = tt
+        self.limits = limits
 
-    board = chess.Board(fen)
+        # While False, `limits` only ends the search when it is stopped,
+        # and not when its budget runs out
+        self.budgeted = True
 
-    if board.is_checkmate():
-        mate_score = -MATE + ply
-        return mate_score, []
+        # When given, positions are evaluated from this incrementally
+        # updated accumulator instead of `evaluate`
+        self.accumulator = accumulator
 
-    if (
-        board.can_claim_draw()
-        or board.is_insufficient_material()
-        or board.is_stalemate()
-    ):
-        return 0, []
+        # Static evaluations, from the perspective of the side to move,
+        # looked up before evaluating a position
+        self.eval_cache = eval_cache
+
+        # search_stats.SearchStats filled in as the search goes, if given
+        self.stats = stats
+
+        # Killers, countermoves and history, kept for the whole search
+        self.move_orderer = move_ordering.MoveOrderer(MAX_PLY)
+
+        # PV of the previous iteration, searched first when following it
+        self.previous_pv = []
+
+        # Position keys of the root and every position pushed since, used
+        # to detect repetitions. Keys are computed on demand by `key`, so
+        # positions that are only evaluated are never hashed.
+        self.keys = [transposition.position_key(board)]
+
+        # pv_table[ply][ply:pv_length[ply]] is the PV of the node at `ply`
+        self.pv_table = [[None] * MAX_PLY for _ in range(MAX_PLY + 1)]
+        self.pv_length = [0] * (MAX_PLY + 1)
+
+    def pv(self, ply=0):
+        return self.pv_table[ply][ply : self.pv_length[ply]]
+
+    def update_pv(self, ply, move):
+        row = self.pv_table[ply]
+        child_length = self.pv_length[ply + 1]
+        row[ply] = move
+        row[ply + 1 : child_length] = self.pv_table[ply + 1][ply + 1 : child_length]
+        self.pv_length[ply] = child_length
+
+    def push(self, move, accumulate=True):
+        """
+        Push `move` on the board, and on the accumulator unless
+        `accumulate` is False, which `pop` must then be given as well.
+        """
+        if self.accumulator is not None and accumulate:
+            self.accumulator.push(self.board, move)
+        else:
+            self.board.push(move)
+        self.keys.append(None)
+
+    def pop(self, accumulate=True):
+        if self.accumulator is not None and accumulate:
+            self.accumulator.pop(self.board)
+        else:
+            self.board.pop()
+        self.keys.pop()
+
+    def key(self):
+        """
+        Position key of the current position.
+        """
+        key = self.keys[-1]
+        if key is None:
+            key = self.keys[-1] = transposition.position_key(self.board)
+        return key
+
+    def is_repetition(self):
+        """
+        Whether the current position occurred before, since the root of
+        the search. Only positions with the same side to move and since
+        the last capture or pawn move, which the halfmove clock counts,
+        can be repetitions.
+        """
+        key = self.key()
+        keys = self.keys
+        oldest = max(len(keys) - 1 - self.board.halfmove_clock, 0)
+        for i in range(len(keys) - 5, oldest - 1, -2):
+            if keys[i] == key:
+                return True
+        return False
+
+    def phase(self, name):
+        return search_stats.phase(self.stats, name)
+
+    def alpha_beta(self, depth, alpha, beta, ply=0, on_pv=True):
+        board = self.board
+        stats = self.stats
+        self.pv_length[ply] = ply
+
+        if self.limits is not None:
+            self.limits.visit(budget=self.budgeted)
+
+        # Counted as a node by quiescence
+        if depth == 0 or ply >= MAX_PLY:
+            stand_pat = self.evaluate_position()
+            return self.quiescence(alpha, beta, ply, stand_pat)
+
+        if stats is not None:
+            stats.nodes += 1
+
+        if self.is_repetition() or board.is_insufficient_material():
+            return 0
+
+        # Legal moves are generated once, for the mate and stalemate checks
+        # as well as the move loop
+        with self.phase("movegen"):
+            legal_moves = list(board.legal_moves)
+        if not legal_moves:
+            if board.is_check():
+                return -MATE + ply
+            return 0
+
+        if board.halfmove_clock >= 100:
+            return 0
+
+        tt = self.tt
+        key = self.key()
+        hash_move = None
+        if tt is not None:
+            entry = tt.probe(key)
+            if entry is not None:
+                if stats is not None:
+                    stats.tt_hits += 1
+                hash_move = entry.move
+                # Never cut at the root, the caller needs a move to play.
+                if ply > 0 and entry.depth >= depth:
+                    score = score_from_tt(entry.score, ply)
+                    if entry.bound == transposition.EXACT:
+                        if entry.move:
+                            self.pv_table[ply][ply] = entry.move
+                            self.pv_length[ply] = ply + 1
+                        return score
+                    if entry.bound == transposition.LOWER and score >= beta:
+                        return beta
+                    if entry.bound == transposition.UPPER and score <= alpha:
+                        return alpha
+
+        pv_move = None
+        if on_pv and ply < len(self.previous_pv):
+            pv_move = self.previous_pv[ply]
+        with self.phase("movegen"):
+            legal_moves = self.move_orderer.order(
+                board, legal_moves, ply, hash_move, pv_move
+            )
+
+        if depth == 1:
+            score, best_move = self.search_leaves(legal_moves, alpha, beta, ply)
+        else:
+            score, best_move = self.search_moves(
+                legal_moves, depth, alpha, beta, ply, pv_move
+            )
+
+        if tt is not None:
+            if score >= beta:
+                bound = transposition.LOWER
+            elif score > alpha:
+                bound = transposition.EXACT
+            else:
+                bound = transposition.UPPER
+            best_move = best_move or hash_move
+            tt.store(key, depth, score_to_tt(score, ply), bound, best_move)
+
+        return score
+
+    def search_moves(self, legal_moves, depth, alpha, beta, ply, pv_move):
+        """
+        Search the moves of an interior node, returning its score and the
+        move that raised alpha or caused a beta cutoff.
+        """
+        board = self.board
+        best_eval = float("-inf")
+        best_move = None
+        quiets = []
+        for i, move in enumerate(legal_moves):
+            self.push(move)
+            candidate_eval = -self.alpha_beta(
+                depth - 1,
+                -beta,
+                -alpha,
+                ply + 1,
+                pv_move is not None and move == pv_move,
+            )
+            self.pop()
+
+            if candidate_eval >= beta:
+                self.pv_length[ply] = ply
+                self.move_orderer.update(board, move, ply, depth, quiets)
+                if self.stats is not None:
+                    self.stats.cutoffs[i] += 1
+                return beta, move
+
+            if move_ordering.is_quiet(board, move):
+                quiets.append(move)
+
+            if candidate_eval > best_eval:
+                best_eval = candidate_eval
+
+                if best_eval > alpha:
+                    alpha = best_eval
+                    best_move = move
+                    self.update_pv(ply, move)
+
+        return alpha, best_move
+
+    def search_leaves(self, legal_moves, alpha, beta, ply):
+        """
+        Search a depth 1 node: every child position is scored in a single
+        call to `evaluate` and then resolved by quiescence, starting from
+        that score.
+        """
+        board = self.board
+        stand_pats = self.evaluate_children(legal_moves)
+
+        best_eval = float("-inf")
+        best_move = None
+        quiets = []
+        for i, (move, stand_pat) in enumerate(zip(legal_moves, stand_pats)):
+            self.push(move)
+            candidate_eval = -self.quiescence(-beta, -alpha, ply + 1, stand_pat)
+            self.pop()
+
+            if candidate_eval >= beta:
+                self.pv_length[ply] = ply
+                self.move_orderer.update(board, move, ply, 1, quiets)
+                if self.stats is not None:
+                    self.stats.cutoffs[i] += 1
+                return beta, move
+
+            if move_ordering.is_quiet(board, move):
+                quiets.append(move)
+
+            if candidate_eval > best_eval:
+                best_eval = candidate_eval
+
+                if best_eval > alpha:
+                    alpha = best_eval
+                    best_move = move
+                    self.update_pv(ply, move)
+
+        return alpha, best_move
+
+    def quiescence(self, alpha, beta, ply, stand_pat):
+        """
+        Search captures until the position is quiet. `stand_pat` is the
+        static evaluation of the current position, which its parent scored
+        together with its siblings.
+        """
+        self.pv_length[ply] = ply
+        if self.stats is not None:
+            self.stats.nodes += 1
+
+        if stand_pat >= beta:
+            return beta
+
+        if ply >= MAX_PLY:
+            return stand_pat
+
+        if stand_pat > alpha:
+            alpha = stand_pat
+
+        # Delta pruning, skip captures that cannot raise alpha
+        board = self.board
+        with self.phase("movegen"):
+            captures = [
+                move
+                for move in board.generate_legal_captures()
+                if move.promotion
+                or stand_pat + capture_value(board, move) + DELTA_MARGIN > alpha
+            ]
+            # MVV-LVA ordering
+            captures.sort(reverse=True, key=lambda move: sort_moves(board, move))
+        if not captures:
+            return alpha
+
+        stand_pats = self.evaluate_children(captures)
+
+        for i, (move, child_stand_pat) in enumerate(zip(captures, stand_pats)):
+            self.push(move)
+            score = -self.quiescence(-beta, -alpha, ply + 1, child_stand_pat)
+            self.pop()
+
+            if score >= beta:
+                self.pv_length[ply] = ply
+                if self.stats is not None:
+                    self.stats.cutoffs[i] += 1
+                return beta
+
+            if score > alpha:
+                alpha = score
+                self.update_pv(ply, move)
+
+        return alpha
+
+    def evaluate_position(self):
+        """
+        Static evaluation of the current position, from the perspective of
+        the side to move.
+        """
+        board = self.board
+        cache = self.eval_cache
+        stats = self.stats
+        if cache is not None:
+            key = self.key()
+            score = cache.get(key)
+            if score is not None:
+                if stats is not None:
+                    stats.eval_cache_hits += 1
+                return score
+
+        if stats is not None:
+            stats.record_batch(1)
+        if self.accumulator is not None:
+            with self.phase("featurize"):
+                snapshot = self.accumulator.snapshot(board)
+            with self.phase("forward"):
+                score = self.accumulator.evaluate([snapshot])[0]
+        else:
+            with self.phase("featurize"):
+                position = self.position_input()
+            with self.phase("forward"):
+                score = relative_eval(board.turn, self.evaluate([position])[0])
+
+        if cache is not None:
+            cache.put(key, score)
+        return score
+
+    def position_input(self):
+        """
+        The current position as passed to `evaluate`.
+        """
+        if self.pack is not None:
+            return self.pack(self.board)
+        return self.board.fen()
+
+    def evaluate_children(self, moves):
+        """
+        Score the positions after each of `moves` in a single batch, from
+        the perspective of the side to move in them. Positions found in
+        the evaluation cache are left out of the batch.
+        """
+        if not moves:
+            return []
+
+        if self.limits is not None:
+            self.limits.visit(len(moves), budget=self.budgeted)
+
+        board = self.board
+        accumulator = self.accumulator
+        cache = self.eval_cache
+        stats = self.stats
+        scores = [None] * len(moves)
+        keys = [None] * len(moves)
+        pending = []
+        inputs = []
+        with self.phase("featurize"):
+            if accumulator is not None and cache is None:
+                pending = list(range(len(moves)))
+            else:
+                # The accumulators of the children are computed together
+                # below, the board is only needed for keys and inputs
+                for i, move in enumerate(moves):
+                    self.push(move, accumulate=False)
+                    if cache is not None:
+                        keys[i] = self.key()
+                        scores[i] = cache.get(keys[i])
+                    if scores[i] is None:
+                        pending.append(i)
+                        if accumulator is None:
+                            inputs.append(self.position_input())
+                    self.pop(accumulate=False)
+            if accumulator is not None and pending:
+                inputs = accumulator.children(board, [moves[i] for i in pending])
+
+        if stats is not None:
+            stats.eval_cache_hits += len(moves) - len(pending)
+        if not pending:
+            return scores
+
+        if stats is not None:
+            stats.record_batch(len(inputs))
+        with self.phase("forward"):
+            if accumulator is not None:
+                evaluations = accumulator.evaluate_batch(*inputs)
+            else:
+                them = not board.turn
+                evaluations = [
+                    relative_eval(them, evaluation)
+                    for evaluation in self.evaluate(inputs)
+                ]
+
+        for i, score in zip(pending, evaluations):
+            scores[i] = score
+            if cache is not None:
+                cache.put(keys[i], score)
+        return scores
+
+    def aspiration_search(self, depth, previous_score):
+        """
+        Search with a narrow window around the previous iteration's score,
+        opening the failing side of the window and searching again if the
+        score falls outside of it.
+        """
+        if abs(previous_score) >= MIN_MATE_SCORE:
+            alpha, beta = float("-inf"), float("inf")
+        else:
+            alpha = previous_score - ASPIRATION_WINDOW
+            beta = previous_score + ASPIRATION_WINDOW
+
+        while True:
+            score = self.alpha_beta(depth, alpha, beta)
+            if score <= alpha:
+                alpha = float("-inf")
+            elif score >= beta:
+                beta = float("inf")
+            else:
+                return score
+
+
+def capture_value(board, move):
+    """
+    Value in pawns of the piece captured by `move`.
+    """
+    if board.is_en_passant(move):
+        return PIECE_VALUES[chess.PAWN] / 100
+    return PIECE_VALUES[board.piece_type_at(move.to_square)] / 100
+
+
+def alpha_beta(
+    fen,
+    depth,
+    alpha,
+    beta,
+    evaluate,
+    ply=0,
+    tt=None,
+    limits=None,
+    model=None,
+    eval_cache=None,
+    stats=None,
+    pack=None,
+):
+    """
+    Search `fen` to the given depth and return its score, from the
+    perspective of the side to move, and principal variation.
+
+    If `model` is given, positions are evaluated incrementally with it
+    instead of through `evaluate`. If `pack` is given, `evaluate` takes
+    `pack(board)` of each position rather than its FEN. If `stats` is
+    given, the search_stats.SearchStats is filled in with the counters and
+    timings of the search.
+    """
+    with search_stats.phase(stats, "search"):
+        search = make_search(fen, evaluate, tt, limits, model, eval_cache, stats, pack)
+        if stats is not None:
+            stats.start_depth()
+        score = search.alpha_beta(depth, alpha, beta, ply)
+        if stats is not None:
+            stats.end_depth(depth)
+    return score, search.pv(ply)
+
+
+def make_search(
+    fen,
+    evaluate,
+    tt=None,
+    limits=None,
+    model=None,
+    eval_cache=None,
+    stats=None,
+    pack=None,
+):
+    board = chess.Board(fen)
+    acc = None if model is None else accumulator.Accumulator(model, board)
+    return Search(board, evaluate, tt, limits, acc, eval_cache, stats, pack)
 
-    legal_moves = sorted(
-        board.legal_moves, reverse=True, key=lambda move: sort_moves(board, move)
-    )
 
-    best_eval = float("-inf")
-    pv = []
-    for move in legal_moves:
-        new_fen = next_fen(fen, move)
+def iterative_deepening(
+    fen,
+    max_depth,
+    evaluate,
+    tt=None,
+    limits=None,
+    model=None,
+    eval_cache=None,
+    stats=None,
+    pack=None,
+):
+    """
+    Search `fen` at depth 1, 2, ... up to `max_depth`, ordering every
+    iteration by the PV of the previous one. When `limits` runs out the
+    result of the last completed iteration is returned. Depth 1 is
+    completed whatever the budget so that there is a move to play, but
+    SearchTimeout is raised when the search is stopped before then.
 
-        candidate_eval, candidate_pv = alpha_beta(
-            new_fen, depth - 1, -beta, -alpha, evaluate, ply + 1
+    Only completed iterations are reported in the depths of `stats`.
+    """
+    with search_stats.phase(stats, "search"):
+        search = make_search(
+            fen,
+            evaluate,
+            tt,
+            limits,
+            model=model,
+            eval_cache=eval_cache,
+            stats=stats,
+            pack=pack,
         )
-        candidate_eval = -candidate_eval
+        if stats is not None:
+            stats.start_depth()
+        search.budgeted = False
+        score = search.alpha_beta(min(max_depth, 1), float("-inf"), float("inf"))
+        pv = search.pv()
+        if stats is not None:
+            stats.end_depth(min(max_depth, 1))
+
+        search.budgeted = True
+        for depth in range(2, max_depth + 1):
+            search.previous_pv = pv
+            if stats is not None:
+                stats.start_depth()
+            try:
+                score = search.aspiration_search(depth, score)
+            except SearchTimeout:
+                break
+            pv = search.pv()
+            if stats is not None:
+                stats.end_depth(depth)
+
+    return score, pv
+
+
+def search_tables(evaluator):
+    """
+    The transposition table and evaluation cache of the searches that
+    evaluate positions with `evaluator`. Scores of different evaluators,
+    such as a net and its quantized form, are never mixed.
+    """
+    with _search_tables_lock:
+        tables = _search_tables.get(evaluator)
+        if tables is None:
+            tables = (transposition.TranspositionTable(), eval_cache.EvalCache())
+            _search_tables[evaluator] = tables
+        return tables
+
+
+def evaluator_id(net_hash=None, quantized=False, remote_endpoint=None):
+    """
+    Identifies where evaluations come from, for evaluation cache files:
+    the remote inference server at `remote_endpoint`, or else the net with
+    content hash `net_hash`, in float or quantized arithmetic.
+    """
+    if remote_endpoint is not None:
+        return "remote:{}".format(remote_endpoint)
+    return "{}:{}".format(net_hash, "quantized" if quantized else "float")
+
+
+def score_to_tt(score, ply):
+    """
+    Mate scores are stored relative to the node rather than the root so
+    that they stay valid when the position is reached at another ply.
+    """
+    if score >= MIN_MATE_SCORE:
+        return score + ply
+    if score <= -MIN_MATE_SCORE:
+        return score - ply
+    return score
 
-        if candidate_eval >= beta:
-            return beta, []
 
-        if candidate_eval > best_eval:
-            best_eval = candidate_eval
+def score_from_tt(score, ply):
+    if score >= MIN_MATE_SCORE:
+        return score - ply
+    if score <= -MIN_MATE_SCORE:
+        return score + ply
+    return score
 
-            if best_eval > alpha:
-                alpha = best_eval
-                pv = [move] + candidate_pv
 
-    return alpha, pv
+def relative_eval(turn, evaluation):
+    """
+    Convert an evaluation from white's perspective to the perspective
+    of `turn`, the side to move, as expected by negamax.
+    """
+    if turn == chess.BLACK:
+        return -evaluation
+    return evaluation
 
 
-def read_model(nnue_path):
+def default_device():
+    """
+    Device to run the net on: the one named by the VIDA_DEVICE environment
+    variable, or a GPU when there is one and the CPU otherwise.
+    """
+    device = os.environ.get(DEVICE_ENV)
+    if device:
+        return device
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def read_model(nnue_path, nnue_hash=None):
+    # A cache built with `serialize.py --build-cache` spares dequantizing.
+    # Callers that hash the net anyway pass its serialize.nnue_file_hash.
+    model = serialize.read_model_cache(nnue_path, FEATURE_SET, nnue_hash)
+    if model is not None:
+        return model
     with open(nnue_path, "rb") as f:
         reader = serialize.NNUEReader(f, FEATURE_SET)
         return reader.model
@@ -110,27 +765,154 @@ def get_algebraic(starting_fen, moves):
     return results
 
 
-def eval_positions_with_search(model, fens, depth, inference_server=None):
+def eval_positions_with_search(
+    model,
+    fens,
+    depth,
+    inference_server=None,
+    tt=None,
+    movetime=None,
+    max_nodes=None,
+    eval_cache=None,
+    stats=None,
+):
     """
     Evaluate a batch of positions with the provided search depth.
+
+    If `stats` is a list, the search_stats.SearchStats of each position
+    is appended to it.
     """
     results = []
     for fen in fens:
-        score, pv = eval_position_with_search(model, fen, depth, inference_server)
+        position_stats = None
+        if stats is not None:
+            position_stats = search_stats.SearchStats()
+            stats.append(position_stats)
+        score, pv = eval_position_with_search(
+            model,
+            fen,
+            depth,
+            inference_server,
+            tt,
+            movetime,
+            max_nodes,
+            eval_cache,
+            position_stats,
+        )
         pv = get_algebraic(fen, pv)
         results.append((score, pv))
     return results
 
 
-def eval_position_with_search(model, fen, depth, inference_server=None):
+def eval_position_with_search(
+    model,
+    fen,
+    depth,
+    inference_server=None,
+    tt=None,
+    movetime=None,
+    max_nodes=None,
+    eval_cache=None,
+    stats=None,
+    book=None,
+    limits=None,
+    evaluator=None,
+    incremental=False,
+):
     """
     Evaluate a single position with the provided search depth.
+
+    If `movetime` (in seconds) or `max_nodes` is given the position is
+    searched with iterative deepening up to `depth`, or without a depth
+    limit when `depth` is None, and the deepest completed result within
+    the budget is returned. Passing SearchLimits as `limits` instead lets
+    the caller stop the search early, which raises SearchTimeout if no
+    iteration was completed yet.
+
+    Search results are kept in `tt` and static evaluations in `eval_cache`
+    between calls, by default the search_tables of `inference_server` or
+    else of `model` are used.
+
+    With `incremental`, a model on the CPU evaluates positions with an
+    incrementally updated accumulator rather than running the feature
+    transformer every time. It is not faster than the batched session yet,
+    so it is off by default.
+    `model` may also be a quantized_nnue.QuantizedNNUE, which evaluates
+    positions with the integer arithmetic of the engine.
+
+    Passing a batch_evaluator.BatchEvaluator of `model` as `evaluator`
+    evaluates positions in batches shared with the other searches using
+    it, such as the searches of concurrent requests of a server.
+
+    If `stats` is given, the search_stats.SearchStats is filled in with
+    the counters and timings of the search.
+
+    Positions found in `book`, an opening_book.OpeningBook, are answered
+    with the book move without searching. Book moves without a stored
+    evaluation are scored with the static evaluation of the position.
     """
+    book_move = None
+    if book is not None:
+        hit = book.lookup(chess.Board(fen))
+        if hit is not None:
+            book_move, score = hit
+            if score is not None:
+                return score, [book_move]
+
+    if tt is None or eval_cache is None:
+        default_tt, default_eval_cache = search_tables(inference_server or model)
+        tt = default_tt if tt is None else tt
+        eval_cache = default_eval_cache if eval_cache is None else eval_cache
+    tt.new_search()
 
+    incremental_model = None
+    pack = None
     if inference_server:
-        evaluate = lambda fen: inference_server.evaluate(fen)
+        evaluate = lambda fens: [inference_server.evaluate(fen) for fen in fens]
+    elif isinstance(model, quantized_nnue.QuantizedNNUE):
+        evaluate = model.evaluate_fens
+    elif evaluator is not None:
+        evaluate = evaluator.evaluate_boards
+        pack = nnue_dataset.pack_board
+    elif incremental and not model.input.weight.is_cuda:
+        # The search evaluates through the incrementally updated
+        # accumulator, and never calls `evaluate`
+        evaluate = None
+        incremental_model = model
     else:
-        evaluate = lambda fen: eval_positions(model, [fen])[0]
+        # Buffers are allocated once for the whole search, and freed with
+        # the session when the search returns
+        session = eval_session.EvaluationSession(model)
+        evaluate = lambda packed: session.evaluate_boards(packed, stats).tolist()
+        pack = nnue_dataset.pack_board
+
+    if book_move is not None:
+        search = make_search(
+            fen,
+            evaluate,
+            tt,
+            model=incremental_model,
+            eval_cache=eval_cache,
+            stats=stats,
+            pack=pack,
+        )
+        return search.evaluate_position(), [book_move]
+
+    if limits is None and (movetime is not None or max_nodes is not None):
+        limits = SearchLimits(movetime, max_nodes)
+    if limits is not None:
+        max_depth = MAX_PLY if depth is None else depth
+        return iterative_deepening(
+            fen,
+            max_depth,
+            evaluate,
+            tt,
+            limits,
+            model=incremental_model,
+            eval_cache=eval_cache,
+            stats=stats,
+            pack=pack,
+        )
 
     return alpha_beta(
         fen,
@@ -138,11 +920,118 @@ def eval_position_with_search(model, fen, depth, inference_server=None):
         float("-inf"),
         float("inf"),
         evaluate,
-        True,
+        tt=tt,
+        model=incremental_model,
+        eval_cache=eval_cache,
+        stats=stats,
+        pack=pack,
     )
 
 
-def eval_positions(model, fens):
+def init_worker(nnue_path, quantized=False, device="cpu"):
+    """
+    Load the net once per worker process, as a quantized_nnue.QuantizedNNUE
+    if `quantized` and otherwise on `device`. Workers run one thread each,
+    the pool provides the parallelism.
+    """
+    global _worker_model
+    torch.set_num_threads(1)
+    if quantized:
+        _worker_model = quantized_nnue.read_quantized_model(nnue_path)
+    else:
+        _worker_model = read_model(nnue_path)
+        _worker_model.eval()
+        _worker_model.to(device)
+
+
+def search_in_worker(fen, depth, movetime, max_nodes):
+    return eval_position_with_search(
+        _worker_model, fen, depth, movetime=movetime, max_nodes=max_nodes
+    )
+
+
+def make_worker_pool(nnue_path, workers, quantized=False, device="cpu"):
+    # Spawn rather than fork, torch does not support forking after its
+    # thread pools have started
+    return concurrent.futures.ProcessPoolExecutor(
+        workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(nnue_path, quantized, device),
+    )
+
+
+def eval_positions_with_search_parallel(
+    nnue_path,
+    fens,
+    depth,
+    workers,
+    movetime=None,
+    max_nodes=None,
+    quantized=False,
+    device="cpu",
+):
+    """
+    Evaluate a batch of positions with the provided search depth, spread
+    over `workers` processes that each load the net at `nnue_path`, see
+    init_worker. Results are returned in the order of `fens`.
+
+    A single position is split up by root moves instead.
+    """
+    with make_worker_pool(nnue_path, workers, quantized, device) as executor:
+        if len(fens) == 1:
+            results = [
+                search_root_moves_parallel(
+                    executor, fens[0], depth, movetime, max_nodes
+                )
+            ]
+        else:
+            futures = [
+                executor.submit(search_in_worker, fen, depth, movetime, max_nodes)
+                for fen in fens
+            ]
+            results = [future.result() for future in futures]
+
+    return [(score, get_algebraic(fen, pv)) for fen, (score, pv) in zip(fens, results)]
+
+
+def search_root_moves_parallel(executor, fen, depth, movetime, max_nodes):
+    """
+    Search every root move of `fen` as a separate task and return the
+    best one. Each root move gets the full `movetime` and `max_nodes`.
+    """
+    board = chess.Board(fen)
+    moves = list(board.legal_moves)
+    if (depth is not None and depth < 1) or not moves:
+        return executor.submit(
+            search_in_worker, fen, depth, movetime, max_nodes
+        ).result()
+
+    futures = []
+    for move in moves:
+        board.push(move)
+        child_depth = None if depth is None else depth - 1
+        futures.append(
+            executor.submit(
+                search_in_worker, board.fen(), child_depth, movetime, max_nodes
+            )
+        )
+        board.pop()
+
+    best_score = float("-inf")
+    best_pv = []
+    for move, future in zip(moves, futures):
+        score, pv = future.result()
+        # Children are searched as roots, so their mate scores count plies
+        # from the child, one ply short of the root
+        score = score_from_tt(-score, 1)
+        if score > best_score:
+            best_score = score
+            best_pv = [move] + pv
+    return best_score, best_pv
+
+
+def eval_positions(model, fens, stats=None):
     """
     Evaluate the list of positions with the model. There is no
     search tree depth involved in this evaluation, this function
@@ -154,49 +1043,15 @@ def eval_positions(model, fens):
         The PyTorch model that evaluates the position
     fens
         List of FEN strings to evaluate
-    """
-    # Make a SparseBatch out of the FENs and extract the features
-    batch = nnue_dataset.make_sparse_batch_from_fens(
-        FEATURE_SET, fens, [0] * len(fens), [1] * len(fens), [0] * len(fens)
-    )
-    (
-        us,
-        them,
-        white_indices,
-        white_values,
-        black_indices,
-        black_values,
-        outcome,
-        score,
-        psqt_indices,
-        layer_stack_indices,
-    ) = batch.contents.get_tensors("cuda")
-
-    # Evaluate the positions and scale them to pawn scores
-    evals = [
-        v.item()
-        for v in model.forward(
-            us,
-            them,
-            white_indices,
-            white_values,
-            black_indices,
-            black_values,
-            psqt_indices,
-            layer_stack_indices,
-        )
-        * 600.0
-        / 208.0
-    ]
-
-    # Set the correct evaluation depending on perspective of score
-    # (e.g. white has advantage vs. black has advantage)
-    for i in range(len(evals)):
-        if them[i] > 0.5:
-            evals[i] = -evals[i]
+    stats
+        Optional search_stats.SearchStats the featurization and forward
+        pass times are charged to
 
-    nnue_dataset.destroy_sparse_batch(batch)
-    return evals
+    Buffers are allocated for each call, use an
+    eval_session.EvaluationSession to evaluate many batches.
+    """
+    with eval_session.EvaluationSession(model, max(len(fens), 1)) as session:
+        return session.evaluate(fens, stats).tolist()
 
 
 def filter_fens(fens):
@@ -225,9 +1080,49 @@ def main():
     parser.add_argument("--fens", type=str, help="path to file of fens")
     parser.add_argument("--pgn", type=str, help="path to pgn")
     parser.add_argument("--depth", type=int, default=3, help="depth of search")
+    parser.add_argument(
+        "--movetime",
+        type=float,
+        default=None,
+        help="search with iterative deepening for at most this many seconds",
+    )
+    parser.add_argument(
+        "--nodes",
+        type=int,
+        default=None,
+        help="search with iterative deepening for at most this many nodes",
+    )
     parser.add_argument(
         "--remote", type=str, default=None, help="path to remote config file"
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes to spread the search over",
+    )
+    parser.add_argument(
+        "--eval-cache",
+        type=str,
+        default=None,
+        help="path to a file the evaluation cache is loaded from and saved to",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default=default_device(),
+        help="device to run the net on, such as cpu or cuda",
+    )
+    parser.add_argument(
+        "--quantized",
+        action="store_true",
+        help="evaluate with integer arithmetic on the quantized weights, on the cpu",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="print search statistics of every position, without --workers",
+    )
 
     parser.add_argument(
         "--no-search",
@@ -236,10 +1131,6 @@ def main():
     )
     args = parser.parse_args()
 
-    model = read_model(args.net)
-    model.eval()
-    model.cuda()
-
     if args.pgn:
         with open(args.pgn) as pgnfile:
             game = chess.pgn.read_game(pgnfile)
@@ -251,8 +1142,34 @@ def main():
 
     fens = filter_fens(fens)
 
-    if args.no_search:
+    parallel = args.workers > 1 and not args.no_search and not args.remote
+    if parallel and args.eval_cache:
+        # Each worker process has its own evaluation cache
+        parser.error("--eval-cache cannot be used with --workers")
+    stats = None
+    if args.quantized and not parallel:
+        model = quantized_nnue.read_quantized_model(args.net)
+    elif not parallel:
+        model = read_model(args.net)
+        model.eval()
+        model.to(args.device)
+
+    if args.no_search and args.quantized:
+        evaluations = model.evaluate_fens(fens)
+    elif args.no_search:
         evaluations = eval_positions(model, fens)
+    elif parallel:
+        print("Using {} worker processes.".format(args.workers))
+        evaluations = eval_positions_with_search_parallel(
+            args.net,
+            fens,
+            args.depth,
+            args.workers,
+            movetime=args.movetime,
+            max_nodes=args.nodes,
+            quantized=args.quantized,
+            device=args.device,
+        )
     else:
         if args.remote:
             with open(args.remote, "r") as cf:
@@ -261,12 +1178,27 @@ def main():
                 config["endpoint"], config["token"]
             )
             print("Using remote inference server.")
+            source = evaluator_id(remote_endpoint=config["endpoint"])
         else:
             inference_server = None
             print("Using local inference.")
+            source = evaluator_id(serialize.nnue_file_hash(args.net), args.quantized)
+        cache = eval_cache.EvalCache(path=args.eval_cache, evaluator_id=source)
+        if args.stats:
+            stats = []
         evaluations = eval_positions_with_search(
-            model, fens, args.depth, inference_server
+            model,
+            fens,
+            args.depth,
+            inference_server,
+            movetime=args.movetime,
+            max_nodes=args.nodes,
+            eval_cache=cache,
+            stats=stats,
         )
+        print("Evaluation cache hit rate: {:.1%}".format(cache.hit_rate()))
+        if args.eval_cache:
+            cache.save()
 
     for i in range(len(fens)):
         fen = fens[i]
@@ -277,6 +1209,8 @@ def main():
             score, moves = evaluations[i]
             moves_string = " ".join(moves)
             print('[eval: {}] {}, position = "{}"'.format(score, moves_string, fen))
+            if stats:
+                print(stats[i].summary())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,27 @@
+"""
+Files that are replaced as a whole, so that a crash while writing one
+never leaves it truncated.
+"""
+
+import contextlib
+import os
+import tempfile
+
+
+@contextlib.contextmanager
+def atomic_write(path):
+    """
+    Path of a temporary file, next to `path`, to write in the with block
+    instead of `path`. The file replaces `path` once the block completes,
+    and is removed if it raises.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=name + ".", suffix=".tmp", dir=directory)
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,181 @@
+"""
+Evaluation of the positions of many concurrent searches in shared batches.
+
+Each search evaluates the children of one node at a time, which leaves a
+GPU mostly idle. A BatchEvaluator collects the requests of all searches
+running in the process, from any thread, and evaluates them together in
+one forward pass, see https://en.wikipedia.org/wiki/Dynamic_batching
+"""
+
+import eval_session
+
+import concurrent.futures
+import queue
+import threading
+import time
+
+DEFAULT_MAX_BATCH_SIZE = 1024
+
+# How long the first request of a batch waits for others to join it
+DEFAULT_MAX_WAIT_US = 200
+
+
+class BatchEvaluator:
+    """
+    Evaluates positions packed by nnue_dataset.pack_board with `model` on
+    a background thread. Requests are gathered into a batch until it holds
+    `max_batch_size` positions or `max_wait_us` microseconds have passed
+    since its first request, and the whole batch goes through a single
+    forward pass.
+
+    A request larger than `max_batch_size` is evaluated on its own, in
+    several forward passes.
+
+    Once closed, or if the background thread fails, requests that are
+    still pending fail and `submit` raises RuntimeError.
+    """
+
+    def __init__(
+        self,
+        model,
+        max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+        max_wait_us=DEFAULT_MAX_WAIT_US,
+    ):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_us / 1e6
+        self.session = eval_session.EvaluationSession(model, max_batch_size)
+        self.requests = queue.Queue()
+
+        # A request that did not fit in the previous batch, which starts
+        # the next one
+        self.pending = None
+
+        # Set under the lock once no more requests are accepted, with the
+        # exception that ended the background thread, if any
+        self.lock = threading.Lock()
+        self.closed = False
+        self.error = None
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """
+        Stop the background thread once the requests already submitted
+        are evaluated.
+        """
+        with self.lock:
+            thread, self.thread = self.thread, None
+            if thread is not None and not self.closed:
+                self.requests.put(None)
+            self.closed = True
+        if thread is not None:
+            thread.join()
+            self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, packed):
+        """
+        A concurrent.futures.Future of the evaluations of the list of
+        packed positions, in pawns from white's perspective.
+        """
+        future = concurrent.futures.Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("The BatchEvaluator is closed") from self.error
+            self.requests.put((packed, future))
+        return future
+
+    def evaluate_boards(self, packed):
+        """
+        Evaluations of the list of packed positions, waiting for them.
+        Usable as the `evaluate` of a search with
+        `pack=nnue_dataset.pack_board`.
+        """
+        if not packed:
+            return []
+        return self.submit(packed).result()
+
+    def run(self):
+        batch = []
+        error = RuntimeError("The BatchEvaluator is closed")
+        try:
+            while True:
+                if self.pending is not None:
+                    request, self.pending = self.pending, None
+                else:
+                    request = self.requests.get()
+                if request is None:
+                    return
+
+                batch = [request]
+                size = len(request[0])
+                deadline = time.perf_counter() + self.max_wait
+                stopping = False
+                while size < self.max_batch_size:
+                    timeout = deadline - time.perf_counter()
+                    if timeout <= 0:
+                        break
+                    try:
+                        request = self.requests.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                    if request is None:
+                        stopping = True
+                        break
+                    if size + len(request[0]) > self.max_batch_size:
+                        self.pending = request
+                        break
+                    batch.append(request)
+                    size += len(request[0])
+
+                self.evaluate_batch(batch)
+                batch = []
+                if stopping:
+                    return
+        except BaseException as e:
+            error = self.error = e
+            raise
+        finally:
+            self.fail_pending(batch, error)
+
+    def fail_pending(self, batch, error):
+        """
+        Stop accepting requests, and fail the futures of the requests in
+        `batch` and of those not evaluated yet with `error`.
+        """
+        with self.lock:
+            self.closed = True
+        requests = list(batch)
+        if self.pending is not None:
+            requests.append(self.pending)
+            self.pending = None
+        while True:
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                requests.append(request)
+        for _, future in requests:
+            if not future.done():
+                future.set_exception(error)
+
+    def evaluate_batch(self, batch):
+        positions = [position for packed, _ in batch for position in packed]
+        try:
+            evaluations = self.session.evaluate_boards(positions).tolist()
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        start = 0
+        for packed, future in batch:
+            future.set_result(evaluations[start : start + len(packed)])
+            start += len(packed)
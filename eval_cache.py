@@ -0,0 +1,101 @@
+"""
+Memoization of static evaluations, shared between searches.
+
+Positions are keyed by their polyglot Zobrist hash, like the
+transposition table. The cache holds the evaluations of a single
+evaluator, and a cache file records its identity, see app.evaluator_id,
+so that it is never reused with another one.
+"""
+
+import atomic_file
+
+import collections
+import os
+import threading
+
+import numpy
+
+DEFAULT_CAPACITY = 1 << 20
+
+
+class EvalCache:
+    """
+    A bounded mapping from position keys to static evaluations, evicting
+    the least recently used entry when full. Entries can be saved to and
+    loaded from `path` so that a restarted process starts warm.
+
+    `evaluator_id` identifies where the evaluations come from, like
+    app.evaluator_id. A file saved for another evaluator is ignored.
+
+    A cache may be used from several threads.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, path=None, evaluator_id=None):
+        self.capacity = capacity
+        self.path = path
+        self.evaluator_id = evaluator_id
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def save(self, path=None):
+        """
+        Write the entries, least recently used first, to `path` or the
+        path the cache was created with.
+        """
+        path = path or self.path
+        with self.lock:
+            items = list(self.entries.items())
+        keys = numpy.fromiter((key for key, _ in items), numpy.uint64, len(items))
+        values = numpy.fromiter(
+            (value for _, value in items), numpy.float64, len(items)
+        )
+
+        with atomic_file.atomic_write(path) as tmp_path:
+            with open(tmp_path, "wb") as f:
+                numpy.savez(
+                    f,
+                    keys=keys,
+                    values=values,
+                    evaluator_id=numpy.str_(self.evaluator_id or ""),
+                )
+
+    def load(self, path):
+        with numpy.load(path) as data:
+            saved_id = str(data["evaluator_id"]) if "evaluator_id" in data else None
+            if saved_id != (self.evaluator_id or ""):
+                print(
+                    "Ignoring the evaluation cache {} of another evaluator".format(path)
+                )
+                return
+            for key, value in zip(data["keys"].tolist(), data["values"].tolist()):
+                self.put(key, value)
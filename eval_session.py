@@ -0,0 +1,164 @@
+"""
+Evaluation of batches of positions with buffers that are reused between
+calls.
+
+nnue_dataset.make_sparse_batch_from_fens allocates a new C++ SparseBatch
+for every batch, and SparseBatch.get_tensors pins and copies each of its
+arrays. At the batch sizes of a search that costs more than the forward
+pass itself. A session instead allocates one batch and its tensors up
+front and refills them in place.
+"""
+
+import nnue_dataset
+import search_stats
+
+import ctypes
+
+import numpy
+import torch
+
+# Room for the children of any position, which have at most 218 moves
+DEFAULT_CAPACITY = 256
+
+
+class EvaluationSession:
+    """
+    Evaluates positions with `model` through a SparseBatch of `capacity`
+    positions and tensors on the model's device, all allocated once.
+    Larger lists of positions are evaluated in chunks of `capacity`.
+
+    A session is not thread safe, and holds C++ memory until it is closed.
+    """
+
+    def __init__(self, model, capacity=DEFAULT_CAPACITY):
+        self.model = model
+        self.capacity = capacity
+        self.device = model.input.weight.device
+        self.feature_set_name = model.feature_set.name.encode("utf-8")
+        self.batch = nnue_dataset.create_sparse_batch(self.feature_set_name, capacity)
+        self.fens = (ctypes.c_char_p * capacity)()
+        self.packed = nnue_dataset.PackedBoards(capacity)
+
+        # Views of the C++ arrays, valid as long as the batch is
+        batch = self.batch.contents
+        features_shape = (capacity, batch.max_active_features)
+        host = [
+            numpy.ctypeslib.as_array(batch.is_white, shape=(capacity, 1)),
+            numpy.ctypeslib.as_array(batch.white, shape=features_shape),
+            numpy.ctypeslib.as_array(batch.white_values, shape=features_shape),
+            numpy.ctypeslib.as_array(batch.black, shape=features_shape),
+            numpy.ctypeslib.as_array(batch.black_values, shape=features_shape),
+            numpy.ctypeslib.as_array(batch.psqt_indices, shape=(capacity,)),
+            numpy.ctypeslib.as_array(batch.layer_stack_indices, shape=(capacity,)),
+        ]
+        self.host = [torch.from_numpy(array) for array in host]
+
+        # The model takes int64 bucket indices, and on a GPU every input
+        # needs a copy on the device. On the CPU the features are read
+        # from the C++ arrays directly.
+        self.inputs = []
+        for tensor in self.host:
+            dtype = torch.long if tensor.dim() == 1 else tensor.dtype
+            if self.device.type == "cpu" and dtype == tensor.dtype:
+                self.inputs.append(tensor)
+            else:
+                self.inputs.append(
+                    torch.empty(tensor.shape, dtype=dtype, device=self.device)
+                )
+        self.them = torch.empty((capacity, 1), device=self.device)
+
+    def close(self):
+        if self.batch is not None:
+            self.host = None
+            self.inputs = None
+            nnue_dataset.destroy_sparse_batch(self.batch)
+            self.batch = None
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def evaluate(self, fens, stats=None):
+        """
+        Evaluations of the list of positions in pawns from white's
+        perspective, as one numpy array, like app.eval_positions.
+        """
+        return self.evaluate_in_chunks(fens, self.fill_from_fens, stats)
+
+    def evaluate_boards(self, packed, stats=None):
+        """
+        Like `evaluate`, for positions packed by nnue_dataset.pack_board
+        rather than FENs, which spares formatting and parsing them.
+        """
+        return self.evaluate_in_chunks(packed, self.fill_from_boards, stats)
+
+    def evaluate_in_chunks(self, positions, fill, stats):
+        evaluations = numpy.empty(len(positions), numpy.float32)
+        for start in range(0, len(positions), self.capacity):
+            chunk = positions[start : start + self.capacity]
+            with search_stats.phase(stats, "featurize"):
+                if not fill(chunk):
+                    raise Exception("Could not featurize the positions")
+            end = start + len(chunk)
+            evaluations[start:end] = self.evaluate_batch(len(chunk), stats)
+        return evaluations
+
+    def fill_from_fens(self, fens):
+        n = len(fens)
+        self.fens[:n] = [fen.encode("utf-8") for fen in fens]
+        return nnue_dataset.fill_sparse_batch_from_fens(
+            self.feature_set_name, self.batch, n, self.fens
+        )
+
+    def fill_from_boards(self, packed):
+        self.packed.fill(packed)
+        return nnue_dataset.fill_sparse_batch_from_bitboards(
+            self.feature_set_name,
+            self.batch,
+            len(packed),
+            self.packed.bitboards,
+            self.packed.sides_to_move,
+            self.packed.king_squares,
+        )
+
+    def evaluate_batch(self, n, stats):
+        """
+        Evaluate the first `n` positions of the batch.
+        """
+        with search_stats.phase(stats, "featurize"):
+            for host, tensor in zip(self.host, self.inputs):
+                if tensor is not host:
+                    tensor[:n].copy_(host[:n])
+            us = self.inputs[0][:n]
+            them = torch.neg(us, out=self.them[:n]).add_(1.0)
+
+        with search_stats.phase(stats, "forward"):
+            (
+                _,
+                white_indices,
+                white_values,
+                black_indices,
+                black_values,
+                psqt_indices,
+                layer_stack_indices,
+            ) = (tensor[:n] for tensor in self.inputs)
+            with torch.no_grad():
+                values = self.model.forward(
+                    us,
+                    them,
+                    white_indices,
+                    white_values,
+                    black_indices,
+                    black_values,
+                    psqt_indices,
+                    layer_stack_indices,
+                )
+                # Scale to pawns, and to white's perspective
+                values = values[:, 0] * 600.0 / 208.0
+                values = torch.where(them[:, 0] > 0.5, -values, values)
+            return values.cpu().numpy()
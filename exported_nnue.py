@@ -0,0 +1,203 @@
+"""
+Inference graphs of NNUE nets exported by serialize.py, as TorchScript or
+ONNX, and their loader.
+
+model.NNUE cannot be scripted, traced or exported: its forward pass goes
+through the autograd function of the feature transformer, which needs
+cupy on a GPU, and LayerStacks caches gather offsets on the module. The
+InferenceNNUE here computes the same function with plain torch operations
+on the coalesced weights, and loading an exported net needs neither
+pytorch_lightning nor cupy, only torch or onnxruntime.
+
+Export a net with
+
+    python serialize.py data/nn-6877cd24400e.nnue data/nn-6877cd24400e.ts
+    python serialize.py data/nn-6877cd24400e.nnue data/nn-6877cd24400e.onnx
+
+ONNX export and inference need the `onnx` extra, `poetry install -E onnx`.
+Recent versions of torch write the weights of an ONNX graph to a `.data`
+file next to it, which has to be kept with the graph.
+"""
+
+import numpy
+import torch
+from torch import nn
+
+# Names of the inputs and output of the ONNX graph, in the order of
+# model.NNUE.forward
+INPUT_NAMES = [
+    "us",
+    "them",
+    "white_indices",
+    "white_values",
+    "black_indices",
+    "black_values",
+    "psqt_indices",
+    "layer_stack_indices",
+]
+OUTPUT_NAMES = ["evaluation"]
+
+
+class InferenceNNUE(nn.Module):
+    """
+    The inference part of model.NNUE.forward, on real features only.
+
+    `ft_weight` holds the coalesced feature transformer weights, followed
+    by the PSQT weights of each feature, like `ft_bias`. The layer stacks
+    hold the weights of all buckets one after another, with the factorizer
+    of the first layer folded in, as written by serialize.NNUEWriter.
+    """
+
+    def __init__(
+        self,
+        ft_weight,
+        ft_bias,
+        l1_weight,
+        l1_bias,
+        l2_weight,
+        l2_bias,
+        output_weight,
+        output_bias,
+    ):
+        super().__init__()
+        self.l1_size = l1_weight.shape[1]
+        self.num_ls_buckets = output_weight.shape[0]
+        self.l2_size = l1_weight.shape[0] // self.num_ls_buckets - 1
+        self.l3_size = l2_weight.shape[0] // self.num_ls_buckets
+
+        self.ft_weight = nn.Parameter(ft_weight, requires_grad=False)
+        self.ft_bias = nn.Parameter(ft_bias, requires_grad=False)
+        self.l1_weight = nn.Parameter(l1_weight, requires_grad=False)
+        self.l1_bias = nn.Parameter(l1_bias, requires_grad=False)
+        self.l2_weight = nn.Parameter(l2_weight, requires_grad=False)
+        self.l2_bias = nn.Parameter(l2_bias, requires_grad=False)
+        self.output_weight = nn.Parameter(output_weight, requires_grad=False)
+        self.output_bias = nn.Parameter(output_bias, requires_grad=False)
+
+    def transform(self, indices, values):
+        # Empty feature slots have index -1 and value 0
+        rows = self.ft_weight[indices.clamp(min=0).long()]
+        return (rows * values.unsqueeze(-1)).sum(dim=1) + self.ft_bias
+
+    def select(self, x, layer_stack_indices, size: int):
+        # The outputs of the bucket of each position, out of all buckets
+        x = x.reshape(-1, self.num_ls_buckets, size)
+        indices = layer_stack_indices.long().reshape(-1, 1, 1).expand(-1, 1, size)
+        return x.gather(1, indices).reshape(-1, size)
+
+    def forward(
+        self,
+        us,
+        them,
+        white_indices,
+        white_values,
+        black_indices,
+        black_values,
+        psqt_indices,
+        layer_stack_indices,
+    ):
+        wp = self.transform(white_indices, white_values)
+        bp = self.transform(black_indices, black_values)
+        w, wpsqt = torch.split(wp, self.l1_size, dim=1)
+        b, bpsqt = torch.split(bp, self.l1_size, dim=1)
+
+        l0_ = (us * torch.cat([w, b], dim=1)) + (them * torch.cat([b, w], dim=1))
+        l0_ = torch.clamp(l0_, 0.0, 1.0)
+        half = self.l1_size // 2
+        l0_ = torch.cat(
+            [
+                l0_[:, :half] * l0_[:, half : 2 * half],
+                l0_[:, 2 * half : 3 * half] * l0_[:, 3 * half :],
+            ],
+            dim=1,
+        ) * (127 / 128)
+
+        l1 = nn.functional.linear(l0_, self.l1_weight, self.l1_bias)
+        l1 = self.select(l1, layer_stack_indices, self.l2_size + 1)
+        l1x, l1_out = torch.split(l1, self.l2_size, dim=1)
+        l1x = torch.clamp(
+            torch.cat([torch.pow(l1x, 2.0) * (127 / 128), l1x], dim=1), 0.0, 1.0
+        )
+
+        l2 = nn.functional.linear(l1x, self.l2_weight, self.l2_bias)
+        l2x = torch.clamp(self.select(l2, layer_stack_indices, self.l3_size), 0.0, 1.0)
+
+        l3 = nn.functional.linear(l2x, self.output_weight, self.output_bias)
+        l3 = self.select(l3, layer_stack_indices, 1)
+
+        psqt_indices = psqt_indices.long().unsqueeze(dim=1)
+        wpsqt = wpsqt.gather(1, psqt_indices)
+        bpsqt = bpsqt.gather(1, psqt_indices)
+        return l3 + l1_out + (wpsqt - bpsqt) * (us - 0.5)
+
+
+def example_inputs(batch_size, max_active_features=32):
+    """
+    Inputs of an empty batch of `batch_size` positions, with the dtypes of
+    nnue_dataset.SparseBatch.get_tensors, for tracing and exporting.
+    """
+    features = (batch_size, max_active_features)
+    us = torch.ones((batch_size, 1))
+    return (
+        us,
+        1.0 - us,
+        torch.full(features, -1, dtype=torch.int32),
+        torch.zeros(features),
+        torch.full(features, -1, dtype=torch.int32),
+        torch.zeros(features),
+        torch.zeros(batch_size, dtype=torch.long),
+        torch.zeros(batch_size, dtype=torch.long),
+    )
+
+
+class OnnxNNUE:
+    """
+    An ONNX graph exported for a fixed batch size, run with onnxruntime.
+    Called with the inputs of model.NNUE.forward for any number of
+    positions, which are padded or split to the size of the graph.
+    """
+
+    def __init__(self, path):
+        # onnxruntime is only needed to run ONNX graphs
+        import onnxruntime
+
+        self.session = onnxruntime.InferenceSession(path)
+        self.batch_size = self.session.get_inputs()[0].shape[0]
+
+    def __call__(self, *inputs):
+        return self.forward(*inputs)
+
+    def forward(self, *inputs):
+        inputs = [numpy.asarray(x.cpu()) for x in inputs]
+        size = len(inputs[0])
+        outputs = []
+        for start in range(0, size, self.batch_size):
+            chunk = [x[start : start + self.batch_size] for x in inputs]
+            n = len(chunk[0])
+            if n < self.batch_size:
+                chunk = [pad(x, self.batch_size) for x in chunk]
+            feed = {name: x for name, x in zip(INPUT_NAMES, chunk)}
+            outputs.append(self.session.run(OUTPUT_NAMES, feed)[0][:n])
+        return torch.from_numpy(numpy.concatenate(outputs))
+
+
+def pad(x, size):
+    # Padded positions only have empty feature slots, and their outputs
+    # are dropped
+    padding = numpy.zeros((size - len(x),) + x.shape[1:], x.dtype)
+    if x.dtype == numpy.int32 and x.ndim == 2:
+        padding -= 1
+    return numpy.concatenate([x, padding])
+
+
+def read_exported_model(path):
+    """
+    Load a net exported by serialize.py, a TorchScript module or an ONNX
+    graph depending on the extension of `path`. Either one is called with
+    the inputs of model.NNUE.forward.
+    """
+    if path.endswith(".onnx"):
+        return OnnxNNUE(path)
+    model = torch.jit.load(path, map_location="cpu")
+    model.eval()
+    return model
@@ -1,9 +1,15 @@
 import torch
 from torch import nn
 from torch import autograd
-import cupy as cp
+import torch.nn.functional as F
 import math
 
+# cupy is only needed for the CUDA kernels, the CPU path works without it
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+
 def _find_nearest_divisor(value, target):
     divisors = []
     for i in range(1, value+1):
@@ -489,6 +495,17 @@ class DoubleFeatureTransformerSliceFunction(autograd.Function):
 
         return None, None, None, None, weight_grad, bias_grad
 
+def feature_transformer_slice_forward_cpu(feature_indices, feature_values, weight, bias):
+    '''
+        Device agnostic equivalent of the forward kernel, used for tensors
+        that are not on a CUDA device. Empty slots have index -1 and are
+        given a weight of 0.
+    '''
+    active = feature_indices >= 0
+    indices = torch.where(active, feature_indices, torch.zeros_like(feature_indices)).long()
+    values = feature_values * active
+    return F.embedding_bag(indices, weight, per_sample_weights=values, mode='sum') + bias
+
 class FeatureTransformerSlice(nn.Module):
     def __init__(self, num_inputs, num_outputs):
         super(FeatureTransformerSlice, self).__init__()
@@ -500,19 +517,32 @@ class FeatureTransformerSlice(nn.Module):
         self.bias = nn.Parameter(torch.rand(num_outputs, dtype=torch.float32) * (2 * sigma) - sigma)
 
     def forward(self, feature_indices, feature_values):
+        if not self.weight.is_cuda:
+            return feature_transformer_slice_forward_cpu(feature_indices, feature_values, self.weight, self.bias)
         return FeatureTransformerSliceFunction.apply(feature_indices, feature_values, self.weight, self.bias)
 
 class DoubleFeatureTransformerSlice(nn.Module):
-    def __init__(self, num_inputs, num_outputs):
+    def __init__(self, num_inputs, num_outputs, initialize=True):
         super(DoubleFeatureTransformerSlice, self).__init__()
         self.num_inputs = num_inputs
         self.num_outputs = num_outputs
 
+        if not initialize:
+            # The weights are about to be overwritten, see model.NNUE
+            self.weight = nn.Parameter(torch.empty(num_inputs, num_outputs, dtype=torch.float32))
+            self.bias = nn.Parameter(torch.empty(num_outputs, dtype=torch.float32))
+            return
+
         sigma = math.sqrt(1/num_inputs)
         self.weight = nn.Parameter(torch.rand(num_inputs, num_outputs, dtype=torch.float32) * (2 * sigma) - sigma)
         self.bias = nn.Parameter(torch.rand(num_outputs, dtype=torch.float32) * (2 * sigma) - sigma)
 
     def forward(self, feature_indices_0, feature_values_0, feature_indices_1, feature_values_1):
+        if not self.weight.is_cuda:
+            return (
+                feature_transformer_slice_forward_cpu(feature_indices_0, feature_values_0, self.weight, self.bias),
+                feature_transformer_slice_forward_cpu(feature_indices_1, feature_values_1, self.weight, self.bias)
+            )
         return DoubleFeatureTransformerSliceFunction.apply(feature_indices_0, feature_values_0, feature_indices_1, feature_values_1, self.weight, self.bias)
 
 if __name__ == '__main__':
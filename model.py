@@ -22,25 +22,35 @@ def coalesce_ft_weights(model, layer):
 def get_parameters(layers):
   return [p for layer in layers for p in layer.parameters()]
 
+'''
+An nn.Linear whose parameters are left uninitialized when `initialize` is
+False, for weights that are about to be overwritten.
+'''
+def make_linear(in_features, out_features, initialize=True):
+  if initialize:
+    return nn.Linear(in_features, out_features)
+  return nn.utils.skip_init(nn.Linear, in_features, out_features)
+
 class LayerStacks(nn.Module):
-  def __init__(self, count):
+  def __init__(self, count, initialize=True):
     super(LayerStacks, self).__init__()
 
     self.count = count
-    self.l1 = nn.Linear(2 * L1 // 2, (L2 + 1) * count)
+    self.l1 = make_linear(2 * L1 // 2, (L2 + 1) * count, initialize)
     # Factorizer only for the first layer because later
     # there's a non-linearity and factorization breaks.
     # This is by design. The weights in the further layers should be
     # able to diverge a lot.
-    self.l1_fact = nn.Linear(2 * L1 // 2, L2 + 1, bias=True)
-    self.l2 = nn.Linear(L2*2, L3 * count)
-    self.output = nn.Linear(L3, 1 * count)
+    self.l1_fact = make_linear(2 * L1 // 2, L2 + 1, initialize)
+    self.l2 = make_linear(L2*2, L3 * count, initialize)
+    self.output = make_linear(L3, 1 * count, initialize)
 
     # Cached helper tensor for choosing outputs by bucket indices.
     # Initialized lazily in forward.
     self.idx_offset = None
 
-    self._init_layers()
+    if initialize:
+      self._init_layers()
 
   def _init_layers(self):
     l1_weight = self.l1.weight
@@ -74,11 +84,17 @@ class LayerStacks(nn.Module):
     self.output.bias = nn.Parameter(output_bias)
 
   def forward(self, x, ls_indices):
-    # Precompute and cache the offset for gathers
-    if self.idx_offset == None or self.idx_offset.shape[0] != x.shape[0]:
-      self.idx_offset = torch.arange(0,x.shape[0]*self.count,self.count, device=ls_indices.device)
+    if not self.training:
+      return self.forward_selected(x, ls_indices)
+
+    # Precompute and cache the offset for gathers. Read into a local so that
+    # concurrent calls with other batch sizes cannot swap it mid-call.
+    idx_offset = self.idx_offset
+    if idx_offset == None or idx_offset.shape[0] != x.shape[0]:
+      idx_offset = torch.arange(0,x.shape[0]*self.count,self.count, device=ls_indices.device)
+      self.idx_offset = idx_offset
 
-    indices = ls_indices.flatten() + self.idx_offset
+    indices = ls_indices.flatten() + idx_offset
 
     l1s_ = self.l1(x).reshape((-1, self.count, L2 + 1))
     l1f_ = self.l1_fact(x)
@@ -102,6 +118,59 @@ class LayerStacks(nn.Module):
 
     return l3x_
 
+  '''
+  Inference version of forward. Instead of running every bucket on every
+  position and gathering the selected outputs, the positions are grouped by
+  bucket and each group only goes through the slices of l1, l2 and output
+  that belong to its bucket, which is count times less work in the layer
+  stacks. The output is the same up to the summation order of the matmuls.
+  '''
+  def forward_selected(self, x, ls_indices):
+    ls_indices = ls_indices.flatten()
+    if x.shape[0] == 0:
+      return x.new_empty((0, 1))
+
+    # Sort the positions by bucket so that each group is a contiguous slice.
+    # The children of a node in a search usually share their bucket.
+    if bool((ls_indices == ls_indices[0]).all()):
+      order = None
+      counts = [x.shape[0]]
+      buckets = [int(ls_indices[0])]
+    else:
+      order = torch.argsort(ls_indices)
+      x = x.index_select(0, order)
+      counts = torch.bincount(ls_indices, minlength=self.count).tolist()
+      buckets = range(self.count)
+    l1f_ = self.l1_fact(x)
+
+    outputs = []
+    start = 0
+    for i, n in zip(buckets, counts):
+      if n == 0:
+        continue
+      xs_ = x[start:start+n]
+      l1f_s = l1f_[start:start+n]
+      start += n
+      l1 = slice(i*(L2+1), (i+1)*(L2+1))
+      l2 = slice(i*L3, (i+1)*L3)
+
+      l1c_ = F.linear(xs_, self.l1.weight[l1], self.l1.bias[l1])
+      l1c_, l1c_out = l1c_.split(L2, dim=1)
+      l1f_s, l1f_out = l1f_s.split(L2, dim=1)
+      l1x_ = l1c_ + l1f_s
+      # multiply sqr crelu result by (127/128) to match quantized version
+      l1x_ = torch.clamp(torch.cat([torch.pow(l1x_, 2.0) * (127/128), l1x_], dim=1), 0.0, 1.0)
+
+      l2x_ = torch.clamp(F.linear(l1x_, self.l2.weight[l2], self.l2.bias[l2]), 0.0, 1.0)
+
+      l3c_ = F.linear(l2x_, self.output.weight[i:i+1], self.output.bias[i:i+1])
+      outputs.append(l3c_ + l1f_out + l1c_out)
+
+    l3x_ = torch.cat(outputs) if len(outputs) > 1 else outputs[0]
+    if order is not None:
+      l3x_ = l3x_.new_empty(l3x_.shape).index_copy_(0, order, l3x_)
+    return l3x_
+
   def get_coalesced_layer_stacks(self):
     # During training the buckets are represented by a single, wider, layer.
     # This representation needs to be transformed into individual layers
@@ -131,14 +200,17 @@ class NNUE(pl.LightningModule):
   gamma - the multiplicative factor applied to the learning rate after each epoch
 
   lr - the initial learning rate
+
+  initialize = False - leave the parameters uninitialized, for loading
+  weights that overwrite all of them, see serialize.NNUEReader
   """
-  def __init__(self, feature_set, start_lambda=1.0, end_lambda=1.0, max_epoch=800, gamma=0.992, lr=8.75e-4, param_index=0, num_psqt_buckets=8, num_ls_buckets=8):
+  def __init__(self, feature_set, start_lambda=1.0, end_lambda=1.0, max_epoch=800, gamma=0.992, lr=8.75e-4, param_index=0, num_psqt_buckets=8, num_ls_buckets=8, initialize=True):
     super(NNUE, self).__init__()
     self.num_psqt_buckets = num_psqt_buckets
     self.num_ls_buckets = num_ls_buckets
-    self.input = DoubleFeatureTransformerSlice(feature_set.num_features, L1 + self.num_psqt_buckets)
+    self.input = DoubleFeatureTransformerSlice(feature_set.num_features, L1 + self.num_psqt_buckets, initialize)
     self.feature_set = feature_set
-    self.layer_stacks = LayerStacks(self.num_ls_buckets)
+    self.layer_stacks = LayerStacks(self.num_ls_buckets, initialize)
     self.start_lambda = start_lambda
     self.end_lambda = end_lambda
     self.max_epoch = max_epoch
@@ -159,7 +231,8 @@ class NNUE(pl.LightningModule):
       {'params' : [self.layer_stacks.output.weight], 'min_weight' : -max_out_weight, 'max_weight' : max_out_weight },
     ]
 
-    self._init_layers()
+    if initialize:
+      self._init_layers()
 
   '''
   We zero all virtual feature weights because there's not need for them
@@ -264,6 +337,14 @@ class NNUE(pl.LightningModule):
 
   def forward(self, us, them, white_indices, white_values, black_indices, black_values, psqt_indices, layer_stack_indices):
     wp, bp = self.input(white_indices, white_values, black_indices, black_values)
+    return self.forward_accumulators(us, them, wp, bp, psqt_indices, layer_stack_indices)
+
+  '''
+  The part of forward that follows the feature transformer. wp and bp are
+  the feature transformer outputs of the white and black perspective, as
+  computed by self.input or kept up to date incrementally during search.
+  '''
+  def forward_accumulators(self, us, them, wp, bp, psqt_indices, layer_stack_indices):
     w, wpsqt = torch.split(wp, L1, dim=1)
     b, bpsqt = torch.split(bp, L1, dim=1)
     l0_ = (us * torch.cat([w, b], dim=1)) + (them * torch.cat([b, w], dim=1))
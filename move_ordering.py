@@ -0,0 +1,184 @@
+"""
+Move ordering for the alpha-beta search in app.py.
+
+Moves are tried in this order: the move of the previous iteration's PV,
+the hash move, winning and equal captures by static exchange evaluation,
+the two killer moves of the ply, the countermove of the previous move,
+the remaining quiet moves by their history score and finally losing
+captures. See https://www.chessprogramming.org/Move_Ordering
+"""
+
+import chess
+
+# Piece values in centipawns for static exchange evaluation, indexed by
+# chess.PieceType. The king can never be exchanged, so its value only
+# needs to dwarf everything else.
+SEE_VALUES = [0, 100, 300, 300, 500, 900, 20000]
+
+# History scores are kept within +-MAX_HISTORY, below the killer and
+# countermove scores
+MAX_HISTORY = 16384
+
+PV_SCORE = 4000000
+HASH_SCORE = 3000000
+GOOD_CAPTURE_SCORE = 2000000
+KILLER_SCORE = 1000000
+COUNTERMOVE_SCORE = 900000
+BAD_CAPTURE_SCORE = -2000000
+
+
+def attackers_mask(board, square, occupied):
+    """
+    Pieces of both colors attacking `square` when only the squares in
+    `occupied` are occupied, used to reveal x-ray attackers.
+    """
+    queens_and_rooks = board.queens | board.rooks
+    queens_and_bishops = board.queens | board.bishops
+    rank_pieces = chess.BB_RANK_MASKS[square] & occupied
+    file_pieces = chess.BB_FILE_MASKS[square] & occupied
+    diag_pieces = chess.BB_DIAG_MASKS[square] & occupied
+
+    attackers = (
+        (chess.BB_KING_ATTACKS[square] & board.kings)
+        | (chess.BB_KNIGHT_ATTACKS[square] & board.knights)
+        | (chess.BB_RANK_ATTACKS[square][rank_pieces] & queens_and_rooks)
+        | (chess.BB_FILE_ATTACKS[square][file_pieces] & queens_and_rooks)
+        | (chess.BB_DIAG_ATTACKS[square][diag_pieces] & queens_and_bishops)
+        | (
+            chess.BB_PAWN_ATTACKS[chess.WHITE][square]
+            & board.pawns
+            & board.occupied_co[chess.BLACK]
+        )
+        | (
+            chess.BB_PAWN_ATTACKS[chess.BLACK][square]
+            & board.pawns
+            & board.occupied_co[chess.WHITE]
+        )
+    )
+    return attackers & occupied
+
+
+def see(board, move):
+    """
+    Static exchange evaluation of `move`, the material balance in
+    centipawns after both sides keep recapturing on the target square
+    with their least valuable piece for as long as it pays off.
+    Pins are ignored.
+    """
+    to_square = move.to_square
+    occupied = board.occupied & ~chess.BB_SQUARES[move.from_square]
+
+    if board.is_en_passant(move):
+        captured_value = SEE_VALUES[chess.PAWN]
+        occupied &= ~chess.BB_SQUARES[board.ep_square ^ 8]
+    else:
+        captured_value = SEE_VALUES[board.piece_type_at(to_square) or 0]
+
+    if move.promotion:
+        piece_value = SEE_VALUES[move.promotion]
+        captured_value += piece_value - SEE_VALUES[chess.PAWN]
+    else:
+        piece_value = SEE_VALUES[board.piece_type_at(move.from_square)]
+
+    gains = [captured_value]
+    side = not board.turn
+    while True:
+        attackers = attackers_mask(board, to_square, occupied)
+        own_attackers = attackers & board.occupied_co[side]
+        if not own_attackers:
+            break
+
+        for piece_type in chess.PIECE_TYPES:
+            candidates = own_attackers & board.pieces_mask(piece_type, side)
+            if candidates:
+                break
+
+        # The king may only capture when nothing defends the square
+        if piece_type == chess.KING and attackers & board.occupied_co[not side]:
+            break
+
+        gains.append(piece_value - gains[-1])
+        piece_value = SEE_VALUES[piece_type]
+        occupied &= ~(candidates & -candidates)
+        side = not side
+
+    # Either side may stop recapturing when continuing would lose material
+    for i in range(len(gains) - 1, 0, -1):
+        gains[i - 1] = -max(-gains[i - 1], gains[i])
+    return gains[0]
+
+
+def is_quiet(board, move):
+    return not move.promotion and not board.is_capture(move)
+
+
+class MoveOrderer:
+    """
+    Killer, countermove and history tables, kept for the whole search and
+    updated on every beta cutoff by a quiet move.
+    """
+
+    def __init__(self, max_ply):
+        self.killers = [[None, None] for _ in range(max_ply + 1)]
+        # countermoves[from][to] of the previous move
+        self.countermoves = [[None] * 64 for _ in range(64)]
+        # history[color][from][to], the butterfly board of each side
+        self.history = [[[0] * 64 for _ in range(64)] for _ in chess.COLORS]
+
+    def order(self, board, moves, ply, hash_move=None, pv_move=None):
+        killers = self.killers[ply]
+        countermove = None
+        if board.move_stack:
+            previous = board.peek()
+            countermove = self.countermoves[previous.from_square][previous.to_square]
+        history = self.history[board.turn]
+
+        def score(move):
+            if move == pv_move:
+                return PV_SCORE
+            if move == hash_move:
+                return HASH_SCORE
+            if not is_quiet(board, move):
+                value = see(board, move)
+                if value >= 0:
+                    return GOOD_CAPTURE_SCORE + value
+                return BAD_CAPTURE_SCORE + value
+            if move == killers[0]:
+                return KILLER_SCORE + 1
+            if move == killers[1]:
+                return KILLER_SCORE
+            if move == countermove:
+                return COUNTERMOVE_SCORE
+            return history[move.from_square][move.to_square]
+
+        return sorted(moves, key=score, reverse=True)
+
+    def update(self, board, move, ply, depth, quiets):
+        """
+        Record a beta cutoff by `move` at `ply`, `quiets` are the quiet
+        moves that were searched before it without causing a cutoff.
+        """
+        if not is_quiet(board, move):
+            return
+
+        killers = self.killers[ply]
+        if killers[0] != move:
+            killers[1] = killers[0]
+            killers[0] = move
+
+        if board.move_stack:
+            previous = board.peek()
+            self.countermoves[previous.from_square][previous.to_square] = move
+
+        bonus = depth * depth
+        history = self.history[board.turn]
+        self.add_history(history, move, bonus)
+        for quiet in quiets:
+            self.add_history(history, quiet, -bonus)
+
+    @staticmethod
+    def add_history(history, move, bonus):
+        # Scale the bonus down as the score approaches MAX_HISTORY so that
+        # scores stay bounded and recent cutoffs count the most
+        row = history[move.from_square]
+        row[move.to_square] += bonus - row[move.to_square] * abs(bonus) // MAX_HISTORY
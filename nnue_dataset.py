@@ -13,6 +13,13 @@ if not local_dllpath:
 dllpath = os.path.abspath(local_dllpath[0])
 dll = ctypes.cdll.LoadLibrary(dllpath)
 
+def _to_device(tensor, device):
+    # Copies the tensor out of the batch, which is freed with it. Pinned
+    # memory only helps transfers to a GPU and needs one to be present.
+    if device.type == 'cuda':
+        return tensor.pin_memory().to(device=device, non_blocking=True)
+    return tensor.to(device=device, copy=True)
+
 class SparseBatch(ctypes.Structure):
     _fields_ = [
         ('num_inputs', ctypes.c_int),
@@ -29,21 +36,35 @@ class SparseBatch(ctypes.Structure):
         ('black_values', ctypes.POINTER(ctypes.c_float)),
         ('psqt_indices', ctypes.POINTER(ctypes.c_int)),
         ('layer_stack_indices', ctypes.POINTER(ctypes.c_int)),
+        ('capacity', ctypes.c_int),
     ]
 
     def get_tensors(self, device):
-        white_values = torch.from_numpy(np.ctypeslib.as_array(self.white_values, shape=(self.size, self.max_active_features))).pin_memory().to(device=device, non_blocking=True)
-        black_values = torch.from_numpy(np.ctypeslib.as_array(self.black_values, shape=(self.size, self.max_active_features))).pin_memory().to(device=device, non_blocking=True)
-        white_indices = torch.from_numpy(np.ctypeslib.as_array(self.white, shape=(self.size, self.max_active_features))).pin_memory().to(device=device, non_blocking=True)
-        black_indices = torch.from_numpy(np.ctypeslib.as_array(self.black, shape=(self.size, self.max_active_features))).pin_memory().to(device=device, non_blocking=True)
-        us = torch.from_numpy(np.ctypeslib.as_array(self.is_white, shape=(self.size, 1))).pin_memory().to(device=device, non_blocking=True)
+        device = torch.device(device)
+        white_values = _to_device(torch.from_numpy(np.ctypeslib.as_array(self.white_values, shape=(self.size, self.max_active_features))), device)
+        black_values = _to_device(torch.from_numpy(np.ctypeslib.as_array(self.black_values, shape=(self.size, self.max_active_features))), device)
+        white_indices = _to_device(torch.from_numpy(np.ctypeslib.as_array(self.white, shape=(self.size, self.max_active_features))), device)
+        black_indices = _to_device(torch.from_numpy(np.ctypeslib.as_array(self.black, shape=(self.size, self.max_active_features))), device)
+        us = _to_device(torch.from_numpy(np.ctypeslib.as_array(self.is_white, shape=(self.size, 1))), device)
         them = 1.0 - us
-        outcome = torch.from_numpy(np.ctypeslib.as_array(self.outcome, shape=(self.size, 1))).pin_memory().to(device=device, non_blocking=True)
-        score = torch.from_numpy(np.ctypeslib.as_array(self.score, shape=(self.size, 1))).pin_memory().to(device=device, non_blocking=True)
-        psqt_indices = torch.from_numpy(np.ctypeslib.as_array(self.psqt_indices, shape=(self.size,))).long().pin_memory().to(device=device, non_blocking=True)
-        layer_stack_indices = torch.from_numpy(np.ctypeslib.as_array(self.layer_stack_indices, shape=(self.size,))).long().pin_memory().to(device=device, non_blocking=True)
+        outcome = _to_device(torch.from_numpy(np.ctypeslib.as_array(self.outcome, shape=(self.size, 1))), device)
+        score = _to_device(torch.from_numpy(np.ctypeslib.as_array(self.score, shape=(self.size, 1))), device)
+        psqt_indices = _to_device(torch.from_numpy(np.ctypeslib.as_array(self.psqt_indices, shape=(self.size,))).long(), device)
+        layer_stack_indices = _to_device(torch.from_numpy(np.ctypeslib.as_array(self.layer_stack_indices, shape=(self.size,))).long(), device)
         return us, them, white_indices, white_values, black_indices, black_values, outcome, score, psqt_indices, layer_stack_indices
 
+    def get_arrays(self):
+        '''
+        Copies of the inputs of the net as numpy arrays, for evaluating
+        without torch. Empty feature slots have index -1.
+        '''
+        is_white = np.ctypeslib.as_array(self.is_white, shape=(self.size,)).copy()
+        white_indices = np.ctypeslib.as_array(self.white, shape=(self.size, self.max_active_features)).copy()
+        black_indices = np.ctypeslib.as_array(self.black, shape=(self.size, self.max_active_features)).copy()
+        psqt_indices = np.ctypeslib.as_array(self.psqt_indices, shape=(self.size,)).copy()
+        layer_stack_indices = np.ctypeslib.as_array(self.layer_stack_indices, shape=(self.size,)).copy()
+        return is_white, white_indices, black_indices, psqt_indices, layer_stack_indices
+
 SparseBatchPtr = ctypes.POINTER(SparseBatch)
 
 class Fen(ctypes.Structure):
@@ -195,6 +216,70 @@ get_sparse_batch_from_fens = dll.get_sparse_batch_from_fens
 get_sparse_batch_from_fens.restype = SparseBatchPtr
 get_sparse_batch_from_fens.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.POINTER(ctypes.c_char_p), ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int)]
 
+# EXPORT SparseBatch* CDECL create_sparse_batch(const char* feature_set_c, int capacity)
+create_sparse_batch = dll.create_sparse_batch
+create_sparse_batch.restype = SparseBatchPtr
+create_sparse_batch.argtypes = [ctypes.c_char_p, ctypes.c_int]
+
+# EXPORT bool CDECL fill_sparse_batch_from_fens(const char* feature_set_c, SparseBatch* batch, int num_fens, const char* const* fens)
+fill_sparse_batch_from_fens = dll.fill_sparse_batch_from_fens
+fill_sparse_batch_from_fens.restype = ctypes.c_bool
+fill_sparse_batch_from_fens.argtypes = [ctypes.c_char_p, SparseBatchPtr, ctypes.c_int, ctypes.POINTER(ctypes.c_char_p)]
+
+# EXPORT bool CDECL fill_sparse_batch_from_bitboards(const char* feature_set_c, SparseBatch* batch, int num_positions, const std::uint64_t* bitboards, const int* sides_to_move, const int* king_squares)
+fill_sparse_batch_from_bitboards = dll.fill_sparse_batch_from_bitboards
+fill_sparse_batch_from_bitboards.restype = ctypes.c_bool
+fill_sparse_batch_from_bitboards.argtypes = [ctypes.c_char_p, SparseBatchPtr, ctypes.c_int, ctypes.POINTER(ctypes.c_uint64), ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int)]
+
+# EXPORT SparseBatch* CDECL get_sparse_batch_from_bitboards(const char* feature_set_c, int num_positions, const std::uint64_t* bitboards, const int* sides_to_move, const int* king_squares)
+get_sparse_batch_from_bitboards = dll.get_sparse_batch_from_bitboards
+get_sparse_batch_from_bitboards.restype = SparseBatchPtr
+get_sparse_batch_from_bitboards.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.POINTER(ctypes.c_uint64), ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int)]
+
+# Number of bitboards of a packed board, NUM_PACKED_BITBOARDS in training_data_loader.cpp
+NUM_PACKED_BITBOARDS = 7
+
+def pack_board(board):
+    '''
+    The pieces of a python-chess board as taken by the *_from_bitboards
+    functions: the bitboards of the white pieces, black pieces, pawns,
+    knights, bishops, rooks and queens, the side to move, 1 for white, and
+    the squares of the white and black kings.
+    '''
+    return (
+        board.occupied_co[True], board.occupied_co[False],
+        board.pawns, board.knights, board.bishops, board.rooks, board.queens,
+        int(board.turn), board.king(True), board.king(False))
+
+class PackedBoards:
+    '''
+    ctypes arrays holding up to `capacity` packed boards, which can be
+    refilled.
+    '''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.bitboards = (ctypes.c_uint64 * (capacity * NUM_PACKED_BITBOARDS))()
+        self.sides_to_move = (ctypes.c_int * capacity)()
+        self.king_squares = (ctypes.c_int * (capacity * 2))()
+
+    def fill(self, packed):
+        '''
+        Store the boards packed by pack_board in `packed`.
+        '''
+        n = len(packed)
+        self.bitboards[:n * NUM_PACKED_BITBOARDS] = [bb for p in packed for bb in p[:NUM_PACKED_BITBOARDS]]
+        self.sides_to_move[:n] = [p[NUM_PACKED_BITBOARDS] for p in packed]
+        self.king_squares[:n * 2] = [sq for p in packed for sq in p[NUM_PACKED_BITBOARDS + 1:]]
+
+def make_sparse_batch_from_boards(feature_set, boards):
+    '''
+    A SparseBatch of python-chess boards, without going through FENs.
+    Scores, plies and results are zero.
+    '''
+    packed = PackedBoards(len(boards))
+    packed.fill([pack_board(board) for board in boards])
+    return get_sparse_batch_from_bitboards(feature_set.name.encode('utf-8'), len(boards), packed.bitboards, packed.sides_to_move, packed.king_squares)
+
 def make_sparse_batch_from_fens(feature_set, fens, scores, plies, results):
     results_ = (ctypes.c_int*len(scores))()
     scores_ = (ctypes.c_int*len(plies))()
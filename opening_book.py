@@ -0,0 +1,200 @@
+"""
+Polyglot opening books, looked up before searching a position.
+
+Any polyglot .bin book can be used, see
+http://hgm.nubati.net/book_format.html. Books built by this module from
+our own searches additionally store the evaluation of the position, in
+centipawns from the perspective of the side to move, in the learn field
+of each entry. They start with a marker entry, and the learn field of
+books without it, which other tools use for their own data, is ignored.
+
+Build a book from the first moves of the games in some PGN files with
+
+    python opening_book.py --net data/nn-6877cd24400e.nnue \\
+        --pgn data/*.pgn --out data/book.bin
+"""
+
+import app
+
+import argparse
+import os
+import struct
+
+import chess
+import chess.pgn
+import chess.polyglot
+
+# Learn fields hold the evaluation offset by this much, so that the 0 of
+# books that do not store evaluations never decodes to one
+LEARN_OFFSET = 1 << 31
+
+# key, move, weight, learn
+ENTRY_STRUCT = struct.Struct(">QHHI")
+
+# The marker entry that books built by this module start with. No position
+# hashes to key 0 in practice, and readers skip entries of weight 0.
+MARKER_ENTRY = ENTRY_STRUCT.pack(0, 0, 0, 0x4E4E5545)
+
+
+class OpeningBook:
+    """
+    Read only view of the polyglot book at `path`. A book whose file does
+    not exist is empty, so callers can always look positions up.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.reader = None
+        # Whether the learn fields of the book hold evaluations
+        self.scored = False
+        if path is not None and os.path.exists(path):
+            self.reader = chess.polyglot.open_reader(path)
+            with open(path, "rb") as f:
+                self.scored = f.read(ENTRY_STRUCT.size) == MARKER_ENTRY
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def lookup(self, board):
+        """
+        The move with the highest weight for `board` and its evaluation in
+        pawns from the perspective of the side to move, or None when the
+        position is not in the book. The evaluation is None for books
+        not built by this module.
+        """
+        if self.reader is None:
+            return None
+
+        entry = self.reader.get(board)
+        if entry is None:
+            return None
+        if not self.scored:
+            return entry.move, None
+        return entry.move, decode_score(entry.learn)
+
+
+def encode_score(score):
+    centipawns = round(score * 100) + LEARN_OFFSET
+    return min(max(centipawns, 1), (1 << 32) - 1)
+
+
+def decode_score(learn):
+    if learn == 0:
+        return None
+    return (learn - LEARN_OFFSET) / 100
+
+
+def encode_move(board, move):
+    """
+    Polyglot encoding of `move`, in which castling is the king capturing
+    its own rook.
+    """
+    to_square = move.to_square
+    if board.is_castling(move):
+        rook_file = 7 if board.is_kingside_castling(move) else 0
+        to_square = chess.square(rook_file, chess.square_rank(move.from_square))
+
+    promotion = move.promotion - 1 if move.promotion else 0
+    return to_square | move.from_square << 6 | promotion << 12
+
+
+def write_book(path, entries):
+    """
+    Write (board, move, score) `entries` to the polyglot book at `path`,
+    one entry per position, after the marker entry.
+    """
+    records = {}
+    for board, move, score in entries:
+        key = chess.polyglot.zobrist_hash(board)
+        records[key] = (encode_move(board, move), encode_score(score))
+
+    with open(path, "wb") as f:
+        f.write(MARKER_ENTRY)
+        for key in sorted(records):
+            raw_move, learn = records[key]
+            f.write(ENTRY_STRUCT.pack(key, raw_move, 1, learn))
+
+
+def opening_positions(pgn_paths, plies):
+    """
+    Distinct positions within the first `plies` moves of the games in
+    `pgn_paths`, excluding finished games.
+    """
+    seen = set()
+    for pgn_path in pgn_paths:
+        with open(pgn_path) as pgnfile:
+            while True:
+                game = chess.pgn.read_game(pgnfile)
+                if game is None:
+                    break
+
+                board = game.board()
+                for ply, move in enumerate(game.mainline_moves()):
+                    if ply >= plies:
+                        break
+                    key = chess.polyglot.zobrist_hash(board)
+                    if key not in seen and not board.is_game_over():
+                        seen.add(key)
+                        yield board.copy(stack=False)
+                    board.push(move)
+
+
+def build_book(model, pgn_paths, path, plies=16, depth=3, movetime=None):
+    """
+    Search the opening positions of the games in `pgn_paths` and write the
+    best move and evaluation of each to the book at `path`.
+    """
+    entries = []
+    for board in opening_positions(pgn_paths, plies):
+        score, pv = app.eval_position_with_search(
+            model, board.fen(), depth, movetime=movetime
+        )
+        if pv:
+            entries.append((board, pv[0], score))
+    write_book(path, entries)
+    return len(entries)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build a polyglot opening book from our own searches"
+    )
+    parser.add_argument("--net", type=str, help="path to a .nnue net")
+    parser.add_argument("--pgn", type=str, nargs="+", help="paths to pgn files")
+    parser.add_argument("--out", type=str, help="path of the book to write")
+    parser.add_argument(
+        "--plies", type=int, default=16, help="number of plies of each game"
+    )
+    parser.add_argument("--depth", type=int, default=3, help="depth of search")
+    parser.add_argument(
+        "--movetime",
+        type=float,
+        default=None,
+        help="search each position for at most this many seconds",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default=app.default_device(),
+        help="device to run the net on, such as cpu or cuda",
+    )
+    args = parser.parse_args()
+
+    model = app.read_model(args.net)
+    model.eval()
+    model.to(args.device)
+
+    count = build_book(model, args.pgn, args.out, args.plies, args.depth, args.movetime)
+    print("Wrote {} positions to {}".format(count, args.out))
+
+
+if __name__ == "__main__":
+    main()
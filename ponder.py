@@ -0,0 +1,103 @@
+"""
+Pondering, searching the position after the opponent's expected reply
+while the opponent is thinking, see
+https://www.chessprogramming.org/Pondering
+"""
+
+import app
+
+import concurrent.futures
+import threading
+
+import chess
+
+
+class Ponderer:
+    """
+    Runs `search(fen, limits)` on background threads for one game. After
+    our move, the position after the expected reply is searched. When the
+    opponent plays that reply the result is used as is, otherwise the
+    background search is stopped and the actual position is searched.
+
+    Only one search of the game runs at a time. A Ponderer may be used from
+    several threads.
+    """
+
+    def __init__(self, search):
+        self.search = search
+        self.lock = threading.Lock()
+        self.fen = None
+        self.limits = None
+        self.future = None
+
+    def start(self, fen, pv):
+        """
+        Start pondering after our move in `fen`, the first move of `pv`,
+        on the reply that `pv` expects.
+        """
+        previous = self.stop()
+        if len(pv) < 2:
+            return
+
+        board = chess.Board(fen)
+        board.push(pv[0])
+        board.push(pv[1])
+        if board.is_game_over():
+            return
+
+        # The limits are attached before the search starts, so that even
+        # its first iteration can be stopped
+        limits = app.SearchLimits()
+        future = self.submit(board.fen(), limits, after=previous)
+        with self.lock:
+            self.fen = board.fen()
+            self.limits = limits
+            self.future = future
+
+    def submit(self, fen, limits=None, after=None):
+        """
+        A concurrent.futures.Future of `search(fen, limits)`, run on a new
+        background thread once the future `after`, if given, is done.
+        """
+        future = concurrent.futures.Future()
+
+        def run():
+            if after is not None:
+                concurrent.futures.wait([after])
+            try:
+                future.set_result(self.search(fen, limits))
+            except Exception as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+    def stop(self):
+        """
+        Stop the ponder search, if any, without waiting for it to end.
+        Returns the concurrent.futures.Future of the stopped search, or
+        None.
+        """
+        with self.lock:
+            limits, future = self.limits, self.future
+            self.fen = None
+            self.limits = None
+            self.future = None
+        if future is not None:
+            limits.stop()
+        return future
+
+    def take(self, fen):
+        """
+        A concurrent.futures.Future of the result for `fen`: the ponder
+        search if it pondered on `fen`, or else a new background search
+        that starts once the ponder search has stopped.
+        """
+        with self.lock:
+            if self.future is not None and fen == self.fen:
+                future = self.future
+                self.fen = None
+                self.limits = None
+                self.future = None
+                return future
+        return self.submit(fen, after=self.stop())
@@ -1,8 +1,13 @@
 import app
+import batch_evaluator
+import opening_book
 import serialize
 
 from cog import BaseModel, BasePredictor, Input
 
+# Positions in this polyglot book are answered without searching
+BOOK_PATH = "data/book.bin"
+
 class Output(BaseModel):
     evaluation: float
     next_move: str
@@ -18,14 +23,29 @@ class Predictor(BasePredictor):
     def setup(self):
         model = app.read_model("data/nn-6877cd24400e.nnue")
         model.eval()
-        model.cuda()
+        model.to(app.default_device())
         self.model = model
+        # Concurrent predictions share forward passes
+        self.evaluator = batch_evaluator.BatchEvaluator(model)
+        self.book = opening_book.OpeningBook(BOOK_PATH)
 
     def predict(
         self,
         fen: str = Input(description="FEN position to evaluate"),
-        depth: int = Input(description="Depth to search in the tree", default=1, ge=0)
+        depth: int = Input(description="Depth to search in the tree", default=1, ge=0),
+        movetime: float = Input(
+            description="Stop deepening the search after this many seconds",
+            default=None,
+            ge=0,
+        ),
     ) -> Output:
-        evaluation, pv = app.eval_position_with_search(self.model, fen, depth)
+        evaluation, pv = app.eval_position_with_search(
+            self.model,
+            fen,
+            depth,
+            movetime=movetime,
+            book=self.book,
+            evaluator=self.evaluator,
+        )
         next_move_string = app.get_algebraic(fen, pv)[0]
         return Output(evaluation=evaluation, next_move=next_move_string)
@@ -0,0 +1,224 @@
+"""
+Integer inference on the quantized weights of a .nnue file, with NumPy.
+
+serialize.NNUEReader turns the quantized weights back into floats for
+PyTorch. This module keeps them in the layout written by NNUEWriter and
+runs the network the way Stockfish does, so that evaluations match the
+engine's bit for bit:
+
+- int16 feature transformer weights and biases, accumulated with int16
+  wraparound, and int32 PSQT weights,
+- the clipped accumulators of the two halves multiplied pairwise and
+  divided by 128, which is the 127/128 scaling of model.py,
+- int8 weights with int32 biases in the layer stacks, followed by a
+  squared clipped ReLU (>> 19) and a clipped ReLU (>> 6),
+- C++ integer division, which truncates towards zero.
+
+Inputs are padded to 32 in the file and the padding is ignored here.
+"""
+
+import features
+import model as M
+import nnue_dataset
+import serialize
+
+import numpy
+
+FEATURE_SET = features.get_feature_set_from_name("HalfKAv2_hm")
+
+# PSQT and layer stack buckets, see model.NNUE
+NUM_BUCKETS = 8
+
+# Shifts and scales of the quantization, see serialize.NNUEWriter
+WEIGHT_SCALE_BITS = 6
+OUTPUT_SCALE = 16
+QUANTIZED_ONE = 127
+
+# Value of a pawn in the units of the evaluation, as used by app.py
+PAWN_VALUE = 208
+
+
+def _div(a, b):
+    """
+    Integer division truncating towards zero like C++, for b > 0.
+    """
+    return numpy.sign(a) * (numpy.abs(a) // b)
+
+
+def _affine(x, weight, bias):
+    # Integer products and sums stay far below 2**53, so float64 matmul is
+    # exact and much faster than NumPy's integer matmul
+    out = x.astype(numpy.float64) @ weight.T.astype(numpy.float64)
+    return out.astype(numpy.int64) + bias
+
+
+def _sparse_affine(x, weight_columns, bias):
+    """
+    _affine for inputs `x` >= 0 that are mostly zero, with the weights
+    transposed to float64 columns. Like Stockfish's find_nnz, only the
+    columns of the inputs that are nonzero in some row are multiplied. The
+    skipped terms are exact zeros, so the result is the same.
+    """
+    columns = numpy.flatnonzero(x.max(axis=0))
+    if len(columns) * 2 > x.shape[1]:
+        # Gathering the columns would cost more than it saves
+        out = x.astype(numpy.float64) @ weight_columns
+    else:
+        out = x.take(columns, axis=1).astype(numpy.float64) @ weight_columns[columns]
+    return out.astype(numpy.int64) + bias
+
+
+class QuantizedNNUE:
+    """
+    The weights of a .nnue file in their quantized form.
+
+    Feature transformer weights get an extra row of zeros at index
+    `num_features`, where empty feature slots (index -1) are redirected.
+    """
+
+    def __init__(self, ft_bias, ft_weight, psqt_weight, layer_stacks):
+        self.ft_bias = ft_bias
+        self.ft_weight = ft_weight
+        self.psqt_weight = psqt_weight
+        # [(l1 weight, l1 bias, l2 weight, l2 bias, out weight, out bias)]
+        # of each bucket
+        self.layer_stacks = layer_stacks
+        self.num_features = ft_weight.shape[0] - 1
+
+        # The first layer of each bucket as float64 columns, the layout that
+        # _sparse_affine gathers from
+        self.l1_columns = [
+            numpy.ascontiguousarray(stack[0].T, numpy.float64) for stack in layer_stacks
+        ]
+
+    @classmethod
+    def read(cls, f, feature_set):
+        """
+        Read a net written by serialize.NNUEWriter for `feature_set`.
+        """
+        nnue = serialize.NNUEMap(f, feature_set, NUM_BUCKETS, NUM_BUCKETS)
+
+        num_features = feature_set.num_real_features
+        ft_bias = numpy.array(nnue.ft_bias)
+        ft_weight = numpy.zeros((num_features + 1, M.L1), numpy.int16)
+        ft_weight[:num_features] = nnue.ft_weight
+        psqt_weight = numpy.zeros((num_features + 1, NUM_BUCKETS), numpy.int32)
+        psqt_weight[:num_features] = nnue.psqt_weight
+
+        layer_stacks = []
+        for mapped_stack in nnue.layer_stacks:
+            stack = []
+            for bias, weight in mapped_stack:
+                stack.extend([numpy.array(weight), bias.astype(numpy.int64)])
+            layer_stacks.append(tuple(stack))
+
+        return cls(ft_bias, ft_weight, psqt_weight, layer_stacks)
+
+    def accumulate(self, indices):
+        """
+        int16 feature transformer outputs and int32 PSQT values of one
+        perspective, for a batch of (batch, max_active_features) indices.
+        """
+        indices = numpy.where(indices < 0, self.num_features, indices)
+        accumulation = numpy.repeat(self.ft_bias[numpy.newaxis], len(indices), axis=0)
+        psqt = numpy.zeros((len(indices), self.psqt_weight.shape[1]), numpy.int32)
+        for column in indices.T:
+            # int16 additions wrap around like the engine's
+            accumulation += self.ft_weight[column]
+            psqt += self.psqt_weight[column]
+        return accumulation, psqt
+
+    def transform(self, is_white, white_indices, black_indices, psqt_indices):
+        """
+        The transformed features, side to move first, and the PSQT part of
+        the evaluation.
+        """
+        white, white_psqt = self.accumulate(white_indices)
+        black, black_psqt = self.accumulate(black_indices)
+
+        is_white = is_white.astype(bool)[:, numpy.newaxis]
+        halves = []
+        for perspective in [
+            numpy.where(is_white, white, black),
+            numpy.where(is_white, black, white),
+        ]:
+            clipped = numpy.clip(perspective, 0, QUANTIZED_ONE).astype(numpy.int32)
+            halves.append((clipped[:, : M.L1 // 2] * clipped[:, M.L1 // 2 :]) >> 7)
+
+        rows = numpy.arange(len(psqt_indices))
+        us_psqt = numpy.where(is_white, white_psqt, black_psqt)
+        them_psqt = numpy.where(is_white, black_psqt, white_psqt)
+        psqt = _div(
+            us_psqt[rows, psqt_indices].astype(numpy.int64)
+            - them_psqt[rows, psqt_indices],
+            2,
+        )
+        return numpy.concatenate(halves, axis=1), psqt
+
+    def propagate(self, transformed, layer_stack_indices):
+        """
+        The positional part of the evaluation, through the layer stack of
+        each position's bucket.
+        """
+        positional = numpy.zeros(len(transformed), numpy.int64)
+        for bucket in numpy.unique(layer_stack_indices):
+            rows = layer_stack_indices == bucket
+            l1_weight, l1_bias, l2_weight, l2_bias, out_weight, out_bias = (
+                self.layer_stacks[bucket]
+            )
+
+            # Most transformed features are zero after the clipped pairwise
+            # product
+            fc_0 = _sparse_affine(transformed[rows], self.l1_columns[bucket], l1_bias)
+            sqr_0 = numpy.minimum(
+                QUANTIZED_ONE, (fc_0 * fc_0) >> (2 * WEIGHT_SCALE_BITS + 7)
+            )
+            ac_0 = numpy.clip(fc_0 >> WEIGHT_SCALE_BITS, 0, QUANTIZED_ONE)
+            x = numpy.concatenate([sqr_0[:, : M.L2], ac_0[:, : M.L2]], axis=1)
+
+            fc_1 = _affine(x, l2_weight, l2_bias)
+            ac_1 = numpy.clip(fc_1 >> WEIGHT_SCALE_BITS, 0, QUANTIZED_ONE)
+            fc_2 = _affine(ac_1, out_weight, out_bias)
+
+            # The last output of fc_0 is a direct term, rescaled from
+            # 127 * 2**WEIGHT_SCALE_BITS to 600 * OUTPUT_SCALE
+            forward = _div(
+                fc_0[:, M.L2] * (600 * OUTPUT_SCALE),
+                QUANTIZED_ONE * (1 << WEIGHT_SCALE_BITS),
+            )
+            positional[rows] = fc_2[:, 0] + forward
+        return positional
+
+    def evaluate(
+        self, is_white, white_indices, black_indices, psqt_indices, layer_stack_indices
+    ):
+        """
+        Integer evaluations in the engine's internal units, from the
+        perspective of the side to move, as the arrays of
+        nnue_dataset.SparseBatch.get_arrays.
+        """
+        transformed, psqt = self.transform(
+            is_white, white_indices, black_indices, psqt_indices
+        )
+        positional = self.propagate(transformed, layer_stack_indices)
+        return _div(psqt + positional, OUTPUT_SCALE)
+
+    def evaluate_fens(self, fens):
+        """
+        Evaluate the list of positions in pawns from white's perspective,
+        like app.eval_positions.
+        """
+        batch = nnue_dataset.make_sparse_batch_from_fens(
+            FEATURE_SET, fens, [0] * len(fens), [1] * len(fens), [0] * len(fens)
+        )
+        arrays = batch.contents.get_arrays()
+        nnue_dataset.destroy_sparse_batch(batch)
+
+        values = self.evaluate(*arrays)
+        is_white = arrays[0]
+        return (numpy.where(is_white > 0.5, values, -values) / PAWN_VALUE).tolist()
+
+
+def read_quantized_model(nnue_path, feature_set=FEATURE_SET):
+    with open(nnue_path, "rb") as f:
+        return QuantizedNNUE.read(f, feature_set)
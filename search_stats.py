@@ -0,0 +1,140 @@
+"""
+Instrumentation of the alpha-beta search in app.py.
+
+A SearchStats object is filled in by a search when one is passed to it,
+reporting where the nodes and the time of the search went.
+"""
+
+import collections
+import contextlib
+import time
+
+# Context manager of searches that do not collect statistics
+NO_PHASE = contextlib.nullcontext()
+
+
+def phase(stats, name):
+    """
+    Charge the time spent in the `with` block to `name` if `stats` is
+    given, or do nothing otherwise.
+    """
+    return NO_PHASE if stats is None else stats.phase(name)
+
+
+class _Phase:
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.stats.enter(self.name)
+
+    def __exit__(self, *exc_info):
+        self.stats.exit()
+
+
+class SearchStats:
+    """
+    Counters and timings of one or more searches.
+
+    Time is split into exclusive phases: time spent in a nested phase is
+    not charged to the enclosing one, so the phase times add up to the
+    total time of the search.
+    """
+
+    def __init__(self):
+        # Interior, leaf and quiescence nodes visited
+        self.nodes = 0
+        # Positions evaluated by the model, cache hits excluded
+        self.leaf_evals = 0
+        # Number of evaluation batches of each size
+        self.batch_sizes = collections.Counter()
+        # Number of beta cutoffs caused by the n-th move tried at a node
+        self.cutoffs = collections.Counter()
+        self.eval_cache_hits = 0
+        self.tt_hits = 0
+        # Seconds spent in each phase, see `phase`
+        self.times = collections.defaultdict(float)
+        # (depth, nodes, seconds) of each completed iteration
+        self.depths = []
+
+        self.phases = []
+        self.phase_start = None
+        self.depth_start = None
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def enter(self, name):
+        now = time.perf_counter()
+        if self.phases:
+            self.times[self.phases[-1]] += now - self.phase_start
+        self.phases.append(name)
+        self.phase_start = now
+
+    def exit(self):
+        now = time.perf_counter()
+        self.times[self.phases.pop()] += now - self.phase_start
+        self.phase_start = now
+
+    def start_depth(self):
+        self.depth_start = (self.nodes, time.perf_counter())
+
+    def end_depth(self, depth):
+        nodes, start = self.depth_start
+        self.depths.append((depth, self.nodes - nodes, time.perf_counter() - start))
+
+    def record_batch(self, size):
+        self.leaf_evals += size
+        self.batch_sizes[size] += 1
+
+    def total_time(self):
+        return sum(self.times.values())
+
+    def nps(self):
+        seconds = self.total_time()
+        return self.nodes / seconds if seconds else 0.0
+
+    def summary(self):
+        """
+        Human readable report of the statistics, one item per line.
+        """
+        total = self.total_time()
+        batches = sum(self.batch_sizes.values())
+        cutoffs = sum(self.cutoffs.values())
+
+        lines = [
+            "nodes: {}, {:.0f} nps".format(self.nodes, self.nps()),
+            "leaf evaluations: {} in {} batches, {:.1f} per batch".format(
+                self.leaf_evals,
+                batches,
+                self.leaf_evals / batches if batches else 0.0,
+            ),
+            "cache hits: {} evaluation, {} transposition table".format(
+                self.eval_cache_hits, self.tt_hits
+            ),
+        ]
+        if cutoffs:
+            lines.append(
+                "cutoffs by move index: "
+                + ", ".join(
+                    "{}: {:.1%}".format(index, count / cutoffs)
+                    for index, count in sorted(self.cutoffs.items())
+                )
+            )
+        lines.append(
+            "time: {:.3f}s, ".format(total)
+            + ", ".join(
+                "{} {:.1%}".format(name, seconds / total if total else 0.0)
+                for name, seconds in sorted(
+                    self.times.items(), key=lambda item: item[1], reverse=True
+                )
+            )
+        )
+        for depth, nodes, seconds in self.depths:
+            lines.append(
+                "depth {}: {} nodes in {:.3f}s, {:.0f} nps".format(
+                    depth, nodes, seconds, nodes / seconds if seconds else 0.0
+                )
+            )
+        return "\n".join(lines)
@@ -1,5 +1,8 @@
 import argparse
+import atomic_file
+import exported_nnue
 import features
+import hashlib
 import math
 import model as M
 import numpy
@@ -10,6 +13,8 @@ import pytorch_lightning as pl
 from torch.utils.data import DataLoader
 from functools import reduce
 import operator
+import os
+import pickle
 
 def ascii_hist(name, x, bins=6):
   N,X = numpy.histogram(x, bins=bins)
@@ -26,6 +31,35 @@ def ascii_hist(name, x, bins=6):
 # hardcoded for now
 VERSION = 0x7AF32F20
 DEFAULT_DESCRIPTION = "Network trained with the https://github.com/glinscott/nnue-pytorch trainer."
+# ONNX graphs have static shapes, padded to this many positions
+DEFAULT_EXPORT_BATCH_SIZE = 256
+# Width of the blocks of L1 inputs that the engine skips when all zero
+DEFAULT_FTPERM_BLOCK_SIZE = 4
+# Number of positions the feature transformer permutation is measured on
+DEFAULT_FTPERM_COUNT = 16384
+# Model caches are memory mapped where torch.load supports it
+TORCH_LOAD_SUPPORTS_MMAP = torch.__version__ >= '2.1'
+
+'''
+Hash of the fully connected layers of a layer stack, given the number of
+outputs of each layer. Only depends on the architecture, so it can be
+checked without building a model.
+'''
+def get_fc_hash(layer_outputs=(M.L2 + 1, M.L3, 1)):
+  # InputSlice hash
+  prev_hash = 0xEC42E90D
+  prev_hash ^= (M.L1 * 2)
+
+  for out_features in layer_outputs:
+    layer_hash = 0xCC03DAE4
+    layer_hash += out_features
+    layer_hash ^= prev_hash >> 1
+    layer_hash ^= (prev_hash << 31) & 0xFFFFFFFF
+    if out_features != 1:
+      # Clipped ReLU hash
+      layer_hash = (layer_hash + 0x538D24C7) & 0xFFFFFFFF
+    prev_hash = layer_hash
+  return layer_hash
 
 class NNUEWriter():
   """
@@ -52,22 +86,9 @@ class NNUEWriter():
 
   @staticmethod
   def fc_hash(model):
-    # InputSlice hash
-    prev_hash = 0xEC42E90D
-    prev_hash ^= (M.L1 * 2)
-
     # Fully connected layers
     layers = [model.layer_stacks.l1, model.layer_stacks.l2, model.layer_stacks.output]
-    for layer in layers:
-      layer_hash = 0xCC03DAE4
-      layer_hash += layer.out_features // model.num_ls_buckets
-      layer_hash ^= prev_hash >> 1
-      layer_hash ^= (prev_hash << 31) & 0xFFFFFFFF
-      if layer.out_features // model.num_ls_buckets != 1:
-        # Clipped ReLU hash
-        layer_hash = (layer_hash + 0x538D24C7) & 0xFFFFFFFF
-      prev_hash = layer_hash
-    return layer_hash
+    return get_fc_hash([layer.out_features // model.num_ls_buckets for layer in layers])
 
   def write_header(self, model, fc_hash, description):
     self.int32(VERSION) # version
@@ -137,94 +158,349 @@ class NNUEWriter():
   def int32(self, v):
     self.buf.extend(struct.pack("<I", v))
 
+'''
+The inference graph of `model` as an exported_nnue.InferenceNNUE, with the
+feature transformer and layer stacks coalesced like in the .nnue format but
+not quantized. It takes real feature indices only.
+'''
+def make_inference_model(model):
+  with torch.no_grad():
+    ft_weight = M.coalesce_ft_weights(model, model.input)
+    ft_bias = model.input.bias.data.clone()
+    stacks = list(model.layer_stacks.get_coalesced_layer_stacks())
+    inference_model = exported_nnue.InferenceNNUE(
+      ft_weight.cpu(),
+      ft_bias.cpu(),
+      torch.cat([l1.weight.data for l1, l2, output in stacks]).cpu(),
+      torch.cat([l1.bias.data for l1, l2, output in stacks]).cpu(),
+      torch.cat([l2.weight.data for l1, l2, output in stacks]).cpu(),
+      torch.cat([l2.bias.data for l1, l2, output in stacks]).cpu(),
+      torch.cat([output.weight.data for l1, l2, output in stacks]).cpu(),
+      torch.cat([output.bias.data for l1, l2, output in stacks]).cpu())
+  inference_model.eval()
+  return inference_model
+
+'''
+Write the inference graph of `model` as a TorchScript module, which
+exported_nnue.read_exported_model loads for any batch size.
+'''
+def export_torchscript(model, path):
+  scripted = torch.jit.script(make_inference_model(model))
+  torch.jit.save(scripted, path)
+
+'''
+Write the inference graph of `model` as an ONNX graph with the static
+shapes of a batch of `batch_size` positions.
+'''
+def export_onnx(model, path, batch_size=DEFAULT_EXPORT_BATCH_SIZE):
+  inference_model = make_inference_model(model)
+  torch.onnx.export(
+    inference_model,
+    exported_nnue.example_inputs(batch_size),
+    path,
+    input_names=exported_nnue.INPUT_NAMES,
+    output_names=exported_nnue.OUTPUT_NAMES)
+
+'''
+Up to `count` FENs to measure activations on, from a .binpack file or a
+text file with one FEN per line.
+'''
+def read_ftperm_fens(path, count=DEFAULT_FTPERM_COUNT):
+  if path.endswith('.binpack'):
+    # The data loader library is only needed for reading binpacks
+    import nnue_dataset
+    fens = []
+    for batch in nnue_dataset.FenBatchProvider(path, False, 1, batch_size=min(count, 10000)):
+      fens.extend(batch)
+      if len(fens) >= count:
+        break
+    return fens[:count]
+
+  with open(path) as f:
+    return [line.strip() for line in f if line.strip()][:count]
+
+'''
+Whether each of the L1 // 2 pairwise products of the feature transformer
+outputs of `model` is nonzero once quantized, for both perspectives of each
+of `fens`: a (2 * len(fens), L1 // 2) boolean array.
+'''
+def ft_activations(model, fens, batch_size=1024):
+  # The data loader library is only needed for featurizing positions
+  import nnue_dataset
+  active = []
+  for i in range(0, len(fens), batch_size):
+    chunk = fens[i:i+batch_size]
+    batch = nnue_dataset.make_sparse_batch_from_fens(model.feature_set, chunk, [0] * len(chunk), [1] * len(chunk), [0] * len(chunk))
+    us, them, white_indices, white_values, black_indices, black_values, outcome, score, psqt_indices, layer_stack_indices = batch.contents.get_tensors('cpu')
+    nnue_dataset.destroy_sparse_batch(batch)
+    with torch.no_grad():
+      for x in model.input(white_indices, white_values, black_indices, black_values):
+        # The engine's clipped int16 accumulators and their product >> 7
+        x = x[:, :M.L1].mul(model.quantized_one).round().clamp(0, model.quantized_one)
+        products = x[:, :M.L1 // 2] * x[:, M.L1 // 2:]
+        active.append((products >= 128).numpy())
+  return numpy.concatenate(active)
+
+'''
+Fraction of the blocks of `block_size` consecutive L1 inputs of `active`
+that are all zero.
+'''
+def zero_block_fraction(active, block_size=DEFAULT_FTPERM_BLOCK_SIZE):
+  blocks = active.reshape(active.shape[0], -1, block_size)
+  return float((~blocks.any(axis=2)).mean())
+
+'''
+A permutation of the L1 // 2 feature transformer neuron pairs that puts
+neurons which are zero on the same positions next to each other, so that
+more blocks of `block_size` L1 inputs are all zero, like Stockfish's ftperm.
+
+Blocks are built greedily: each starts from the unplaced neuron that is
+most often zero, and grows by the neuron that keeps the block all zero on
+the most positions.
+'''
+def find_ft_permutation(active, block_size=DEFAULT_FTPERM_BLOCK_SIZE):
+  zero = torch.from_numpy(~active).float()
+  num_neurons = active.shape[1]
+  unplaced = torch.ones(num_neurons, dtype=torch.bool)
+  zero_counts = zero.sum(dim=0)
+  permutation = []
+  while len(permutation) < num_neurons:
+    first = int(torch.where(unplaced, zero_counts, -1.0).argmax())
+    unplaced[first] = False
+    permutation.append(first)
+    block_zero = zero[:, first]
+    for _ in range(block_size - 1):
+      scores = torch.where(unplaced, block_zero @ zero, -1.0)
+      neuron = int(scores.argmax())
+      unplaced[neuron] = False
+      permutation.append(neuron)
+      block_zero = block_zero * zero[:, neuron]
+  return permutation
+
+'''
+Reorder the feature transformer neurons of `model` in place, so that new
+neuron pair i is old pair permutation[i]. Each neuron j of the first half
+is multiplied with neuron j + L1 // 2, so both halves are permuted alike,
+and so are the inputs of l1 and l1_fact for both perspectives. The net
+computes the same function afterwards.
+'''
+def permute_ft_neurons(model, permutation):
+  half = torch.tensor(permutation, dtype=torch.long)
+  ft = torch.cat([half, half + M.L1 // 2, torch.arange(M.L1, model.input.bias.shape[0])])
+  l1 = torch.cat([half, half + M.L1 // 2])
+  with torch.no_grad():
+    model.input.weight.data = model.input.weight.data[:, ft].contiguous()
+    model.input.bias.data = model.input.bias.data[ft].contiguous()
+    for layer in [model.layer_stacks.l1, model.layer_stacks.l1_fact]:
+      layer.weight.data = layer.weight.data[:, l1].contiguous()
+
+'''
+Permute the feature transformer of `model` for sparser L1 inputs, measured
+on the positions of `fens`.
+'''
+def ftperm(model, fens, block_size=DEFAULT_FTPERM_BLOCK_SIZE):
+  active = ft_activations(model, fens)
+  print('Zero blocks of {} before: {:.4f}'.format(block_size, zero_block_fraction(active, block_size)))
+  permutation = find_ft_permutation(active, block_size)
+  permute_ft_neurons(model, permutation)
+  print('Zero blocks of {} after: {:.4f}'.format(block_size, zero_block_fraction(active[:, permutation], block_size)))
+
+class NNUEMap():
+  '''
+  A .nnue file mapped into memory, with its quantized arrays exposed as
+  read-only numpy views into the mapping. The offset of each array follows
+  from the header and the architecture, and nothing is copied until the
+  arrays are dequantized, so processes mapping the same file share its
+  pages. `f` is a path or a file opened in binary mode.
+
+  ft_bias and ft_weight are int16, psqt_weight is int32, and each entry of
+  layer_stacks holds the (bias, weight) pairs of l1, l2 and output of a
+  bucket, int32 and int8, without the padding of the weight rows.
+  '''
+  def __init__(self, f, feature_set, num_psqt_buckets=8, num_ls_buckets=8):
+    self.data = numpy.memmap(f, dtype=numpy.uint8, mode='r')
+    self.offset = 0
+    fc_hash = get_fc_hash()
+
+    self.read_int32(VERSION) # version
+    self.read_int32(fc_hash ^ feature_set.hash ^ (M.L1*2))
+    desc_len = self.read_int32()
+    self.description = bytes(self.view(numpy.uint8, [desc_len])).decode('utf-8')
+
+    self.read_int32(feature_set.hash ^ (M.L1*2)) # Feature transformer hash
+    num_features = feature_set.num_real_features
+    self.ft_bias = self.view(numpy.int16, [M.L1])
+    # weights stored as [num_features][outputs]
+    self.ft_weight = self.view(numpy.int16, [num_features, M.L1])
+    self.psqt_weight = self.view(numpy.int32, [num_features, num_psqt_buckets])
+
+    self.layer_stacks = []
+    for i in range(num_ls_buckets):
+      self.read_int32(fc_hash) # FC layers hash
+      stack = []
+      for inputs, outputs in [(M.L1, M.L2+1), (M.L2*2, M.L3), (M.L3, 1)]:
+        # FC inputs are padded to 32 elements by spec.
+        padded_inputs = ((inputs+31)//32)*32
+        bias = self.view(numpy.int32, [outputs])
+        weight = self.view(numpy.int8, [outputs, padded_inputs])
+        stack.append((bias, weight[:, :inputs]))
+      self.layer_stacks.append(stack)
+
+    if self.offset != len(self.data):
+      raise Exception('Unexpected {} bytes at the end of the file.'.format(len(self.data) - self.offset))
+
+  '''
+  A view of the next `shape` values of `dtype` in little endian order.
+  '''
+  def view(self, dtype, shape):
+    dtype = numpy.dtype(dtype).newbyteorder('<')
+    size = reduce(operator.mul, shape, 1) * dtype.itemsize
+    if self.offset + size > len(self.data):
+      raise Exception('Unexpected end of file.')
+    d = self.data[self.offset:self.offset+size].view(dtype).reshape(shape)
+    self.offset += size
+    return d
+
+  def read_int32(self, expected=None):
+    v = int(self.view(numpy.uint32, [1])[0])
+    if expected is not None and v != expected:
+      raise Exception("Expected: %x, got %x" % (expected, v))
+    return v
+
+'''
+Dequantize the integer array `d` into the float tensor `out`, which has
+the same shape, dividing by `scale`.
+'''
+def dequantize_into(out, d, scale):
+  with torch.no_grad():
+    out.detach().numpy()[...] = d
+    out.div_(scale)
+
 class NNUEReader():
   def __init__(self, f, feature_set):
     self.f = f
     self.feature_set = feature_set
-    self.model = M.NNUE(feature_set)
-    fc_hash = NNUEWriter.fc_hash(self.model)
+    # Every parameter is read from the file, so the random and PSQT
+    # initialization of training is skipped
+    self.model = M.NNUE(feature_set, initialize=False)
+    self.nnue = NNUEMap(f, feature_set, self.model.num_psqt_buckets, self.model.num_ls_buckets)
 
-    self.read_header(feature_set, fc_hash)
-    self.read_int32(feature_set.hash ^ (M.L1*2)) # Feature transformer hash
     self.read_feature_transformer(self.model.input, self.model.num_psqt_buckets)
-    for i in range(self.model.num_ls_buckets):
-      l1 = nn.Linear(2*M.L1//2, M.L2+1)
-      l2 = nn.Linear(M.L2*2, M.L3)
-      output = nn.Linear(M.L3, 1)
+    layer_stacks = self.model.layer_stacks
+    with torch.no_grad():
+      for i, ((l1_bias, l1_weight), (l2_bias, l2_weight), (output_bias, output_weight)) in enumerate(self.nnue.layer_stacks):
+        self.read_fc_layer(layer_stacks.l1.weight[i*(M.L2+1):(i+1)*(M.L2+1), :], layer_stacks.l1.bias[i*(M.L2+1):(i+1)*(M.L2+1)], l1_weight, l1_bias)
+        self.read_fc_layer(layer_stacks.l2.weight[i*M.L3:(i+1)*M.L3, :], layer_stacks.l2.bias[i*M.L3:(i+1)*M.L3], l2_weight, l2_bias)
+        self.read_fc_layer(layer_stacks.output.weight[i:(i+1), :], layer_stacks.output.bias[i:(i+1)], output_weight, output_bias, is_output=True)
 
-      self.read_int32(fc_hash) # FC layers hash
-      self.read_fc_layer(l1)
-      self.read_fc_layer(l2)
-      self.read_fc_layer(output, is_output=True)
-
-      self.model.layer_stacks.l1.weight.data[i*(M.L2+1):(i+1)*(M.L2+1), :] = l1.weight
-      self.model.layer_stacks.l1.bias.data[i*(M.L2+1):(i+1)*(M.L2+1)] = l1.bias
-      self.model.layer_stacks.l2.weight.data[i*M.L3:(i+1)*M.L3, :] = l2.weight
-      self.model.layer_stacks.l2.bias.data[i*M.L3:(i+1)*M.L3] = l2.bias
-      self.model.layer_stacks.output.weight.data[i:(i+1), :] = output.weight
-      self.model.layer_stacks.output.bias.data[i:(i+1)] = output.bias
-
-  def read_header(self, feature_set, fc_hash):
-    self.read_int32(VERSION) # version
-    self.read_int32(fc_hash ^ feature_set.hash ^ (M.L1*2))
-    desc_len = self.read_int32()
-    description = self.f.read(desc_len)
-
-  def tensor(self, dtype, shape):
-    d = numpy.fromfile(self.f, dtype, reduce(operator.mul, shape, 1))
-    d = torch.from_numpy(d.astype(numpy.float32))
-    d = d.reshape(shape)
-    return d
+      # The factorizer is folded into l1 in the file
+      layer_stacks.l1_fact.weight.zero_()
+      layer_stacks.l1_fact.bias.zero_()
 
   def read_feature_transformer(self, layer, num_psqt_buckets):
-    shape = layer.weight.shape
-
-    bias = self.tensor(numpy.int16, [layer.bias.shape[0]-num_psqt_buckets]).divide(self.model.quantized_one)
-    # weights stored as [num_features][outputs]
-    weights = self.tensor(numpy.int16, [shape[0], shape[1]-num_psqt_buckets])
-    weights = weights.divide(self.model.quantized_one)
-    psqt_weights = self.tensor(numpy.int32, [shape[0], num_psqt_buckets])
-    psqt_weights = psqt_weights.divide(self.model.nnue2score * self.model.weight_scale_out)
+    num_outputs = layer.weight.shape[1]-num_psqt_buckets
 
-    layer.bias.data = torch.cat([bias, torch.tensor([0]*num_psqt_buckets)])
-    layer.weight.data = torch.cat([weights, psqt_weights], dim=1)
+    with torch.no_grad():
+      dequantize_into(layer.bias[:num_outputs], self.nnue.ft_bias, self.model.quantized_one)
+      layer.bias[num_outputs:].zero_()
+      dequantize_into(layer.weight[:, :num_outputs], self.nnue.ft_weight, self.model.quantized_one)
+      dequantize_into(layer.weight[:, num_outputs:], self.nnue.psqt_weight, self.model.nnue2score * self.model.weight_scale_out)
 
-  def read_fc_layer(self, layer, is_output=False):
+  def read_fc_layer(self, weight, bias, quantized_weight, quantized_bias, is_output=False):
     kWeightScaleHidden = self.model.weight_scale_hidden
     kWeightScaleOut = self.model.nnue2score * self.model.weight_scale_out / self.model.quantized_one
     kWeightScale = kWeightScaleOut if is_output else kWeightScaleHidden
     kBiasScaleOut = self.model.weight_scale_out * self.model.nnue2score
     kBiasScaleHidden = self.model.weight_scale_hidden * self.model.quantized_one
     kBiasScale = kBiasScaleOut if is_output else kBiasScaleHidden
-    kMaxWeight = self.model.quantized_one / kWeightScale
-
-    # FC inputs are padded to 32 elements by spec.
-    non_padded_shape = layer.weight.shape
-    padded_shape = (non_padded_shape[0], ((non_padded_shape[1]+31)//32)*32)
 
-    layer.bias.data = self.tensor(numpy.int32, layer.bias.shape).divide(kBiasScale)
-    layer.weight.data = self.tensor(numpy.int8, padded_shape).divide(kWeightScale)
-
-    # Strip padding.
-    layer.weight.data = layer.weight.data[:non_padded_shape[0], :non_padded_shape[1]]
-
-  def read_int32(self, expected=None):
-    v = struct.unpack("<I", self.f.read(4))[0]
-    if expected is not None and v != expected:
-      raise Exception("Expected: %x, got %x" % (expected, v))
-    return v
+    dequantize_into(bias, quantized_bias, kBiasScale)
+    dequantize_into(weight, quantized_weight, kWeightScale)
+
+'''
+Path of the cache of the dequantized net at `nnue_path` for `feature_set`,
+next to the net.
+'''
+def model_cache_path(nnue_path, feature_set):
+  return '{}.{}.cache'.format(nnue_path, feature_set.name)
+
+def nnue_file_hash(nnue_path):
+  return hashlib.sha256(numpy.memmap(nnue_path, dtype=numpy.uint8, mode='r')).hexdigest()
+
+'''
+Save the parameters of `model`, read from the net at `nnue_path`, as its
+cache. The cache records the hash of the net and the feature set name, so
+that it is never used for another net. `nnue_hash`, the nnue_file_hash of
+the net, is computed when not given.
+'''
+def write_model_cache(model, nnue_path, feature_set, nnue_hash=None):
+  path = model_cache_path(nnue_path, feature_set)
+  state = {
+    'nnue_hash' : nnue_hash or nnue_file_hash(nnue_path),
+    'feature_set' : feature_set.name,
+    'state_dict' : model.state_dict(),
+  }
+  with atomic_file.atomic_write(path) as tmp_path:
+    torch.save(state, tmp_path)
+  return path
+
+'''
+The model cached for the net at `nnue_path` by write_model_cache, or None
+when there is no cache, it belongs to another net or feature set, or it
+is corrupt. From torch 2.1 on, the parameters are memory mapped from the
+cache, and before that they are copied from it. `nnue_hash`, the
+nnue_file_hash of the net, is computed when not given.
+'''
+def read_model_cache(nnue_path, feature_set, nnue_hash=None):
+  path = model_cache_path(nnue_path, feature_set)
+  if not os.path.exists(path):
+    return None
+
+  try:
+    if TORCH_LOAD_SUPPORTS_MMAP:
+      state = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    else:
+      state = torch.load(path, map_location='cpu', weights_only=True)
+  except (OSError, EOFError, RuntimeError, struct.error, pickle.UnpicklingError) as e:
+    print('Ignoring the unreadable model cache {}: {}'.format(path, e))
+    return None
+  if not isinstance(state, dict) or state.get('nnue_hash') != (nnue_hash or nnue_file_hash(nnue_path)) or state.get('feature_set') != feature_set.name:
+    print('Ignoring the model cache {} of another net'.format(path))
+    return None
+
+  model = M.NNUE(feature_set, initialize=False)
+  try:
+    if TORCH_LOAD_SUPPORTS_MMAP:
+      model.load_state_dict(state['state_dict'], assign=True)
+    else:
+      model.load_state_dict(state['state_dict'])
+  except (KeyError, RuntimeError) as e:
+    print('Ignoring the model cache {} of another architecture: {}'.format(path, e))
+    return None
+  return model
 
 def main():
   parser = argparse.ArgumentParser(description="Converts files between ckpt and nnue format.")
   parser.add_argument("source", help="Source file (can be .ckpt, .pt or .nnue)")
-  parser.add_argument("target", help="Target file (can be .pt or .nnue)")
+  parser.add_argument("target", nargs='?', default=None, help="Target file (can be .pt, .nnue, or .ts and .onnx for inference only)")
   parser.add_argument("--description", default=None, type=str, dest='description', help="The description string to include in the network. Only works when serializing into a .nnue file.")
+  parser.add_argument("--ftperm", default=None, type=str, dest='ftperm', help="Permute the feature transformer neurons for sparser L1 inputs, measured on the positions of this .binpack or text file of FENs, before writing the target.")
+  parser.add_argument("--ftperm-count", default=DEFAULT_FTPERM_COUNT, type=int, dest='ftperm_count', help="The number of positions to measure the permutation on.")
+  parser.add_argument("--ftperm-block-size", default=DEFAULT_FTPERM_BLOCK_SIZE, type=int, dest='ftperm_block_size', help="The width of the blocks of L1 inputs to make all zero, 4 or 8.")
+  parser.add_argument("--build-cache", action='store_true', dest='build_cache', help="Write the dequantized model cache that app.read_model loads next to the .nnue source.")
+  parser.add_argument("--batch-size", default=DEFAULT_EXPORT_BATCH_SIZE, type=int, dest='batch_size', help="The number of positions of an exported ONNX graph, whose shapes are static.")
   features.add_argparse_args(parser)
   args = parser.parse_args()
 
   feature_set = features.get_feature_set_from_name(args.features)
 
-  print('Converting %s to %s' % (args.source, args.target))
+  if args.target is None and not args.build_cache:
+    parser.error('a target or --build-cache is required')
+  if args.build_cache and not args.source.endswith('.nnue'):
+    raise Exception('Only .nnue nets can be cached.')
+
+  if args.target is not None:
+    print('Converting %s to %s' % (args.source, args.target))
 
   if args.source.endswith('.ckpt'):
     nnue = M.NNUE.load_from_checkpoint(args.source, feature_set=feature_set)
@@ -238,6 +514,14 @@ def main():
   else:
     raise Exception('Invalid network input format.')
 
+  if args.build_cache:
+    print('Wrote the model cache %s' % write_model_cache(nnue, args.source, feature_set))
+  if args.target is None:
+    return
+
+  if args.ftperm is not None:
+    ftperm(nnue, read_ftperm_fens(args.ftperm, args.ftperm_count), args.ftperm_block_size)
+
   if args.target.endswith('.ckpt'):
     raise Exception('Cannot convert into .ckpt')
   elif args.target.endswith('.pt'):
@@ -246,6 +530,10 @@ def main():
     writer = NNUEWriter(nnue, args.description)
     with open(args.target, 'wb') as f:
       f.write(writer.buf)
+  elif args.target.endswith('.ts'):
+    export_torchscript(nnue, args.target)
+  elif args.target.endswith('.onnx'):
+    export_onnx(nnue, args.target, args.batch_size)
   else:
     raise Exception('Invalid network output format.')
 
@@ -1,10 +1,30 @@
 """Example OctoAI service scaffold: Hello World."""
 import app
+import batch_evaluator
+import eval_cache
+import opening_book
 import serialize
 
+import atexit
+
 from octoai.service import Service
 from octoai.types import Text
 
+# Upper bound on the time spent searching a single request, in seconds
+SEARCH_TIME = 5.0
+
+NET_PATH = "data/nn-6877cd24400e.nnue"
+
+# Evaluations are persisted here so that a restarted service starts warm,
+# as long as the net is the same
+EVAL_CACHE_PATH = "data/nn-6877cd24400e.evalcache"
+
+# Number of requests between saves of the evaluation cache
+EVAL_CACHE_SAVE_INTERVAL = 100
+
+# Positions in this polyglot book are answered without searching
+BOOK_PATH = "data/book.bin"
+
 def read_model(nnue_path):
     with open(nnue_path, "rb") as f:
         reader = serialize.NNUEReader(f, app.FEATURE_SET)
@@ -15,13 +35,41 @@ class Vida(Service):
 
     def setup(self):
         """Perform intialization."""
-        model = app.read_model("data/nn-6877cd24400e.nnue")
+        # Hashed once, for both the model cache and the evaluation cache
+        net_hash = serialize.nnue_file_hash(NET_PATH)
+        model = app.read_model(NET_PATH, net_hash)
         model.eval()
-        model.cuda()
+        model.to(app.default_device())
         self.model = model
 
+        # Concurrent requests share forward passes
+        self.evaluator = batch_evaluator.BatchEvaluator(model)
+        atexit.register(self.evaluator.close)
+
+        self.eval_cache = eval_cache.EvalCache(
+            path=EVAL_CACHE_PATH,
+            evaluator_id=app.evaluator_id(net_hash),
+        )
+        self.requests = 0
+        atexit.register(self.eval_cache.save)
+
+        self.book = opening_book.OpeningBook(BOOK_PATH)
+
     def infer(self, fen: Text) -> Text:
         """Perform inference."""
-        evaluation, pv = app.eval_position_with_search(self.model, fen.text, depth=3)
+        evaluation, pv = app.eval_position_with_search(
+            self.model,
+            fen.text,
+            depth=3,
+            movetime=SEARCH_TIME,
+            eval_cache=self.eval_cache,
+            book=self.book,
+            evaluator=self.evaluator,
+        )
+
+        self.requests += 1
+        if self.requests % EVAL_CACHE_SAVE_INTERVAL == 0:
+            self.eval_cache.save()
+
         next_move_string = app.get_algebraic(fen.text, pv)[0]
         return Text(text=f"{evaluation} {next_move_string}")
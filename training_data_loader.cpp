@@ -367,21 +367,30 @@ struct SparseBatch
     template <typename... Ts>
     SparseBatch(FeatureSet<Ts...>, const std::vector<TrainingDataEntry>& entries)
     {
-        num_inputs = FeatureSet<Ts...>::INPUTS;
+        allocate(FeatureSet<Ts...>{}, entries.size());
+        fill(FeatureSet<Ts...>{}, entries);
+    }
+
+    // An empty batch with room for `capacity` entries, to be filled in place
+    // any number of times with fill.
+    template <typename... Ts>
+    SparseBatch(FeatureSet<Ts...>, int capacity)
+    {
+        allocate(FeatureSet<Ts...>{}, capacity);
+        size = 0;
+        num_active_white_features = 0;
+        num_active_black_features = 0;
+    }
+
+    // Replaces the contents of the batch with `entries`, of which there must
+    // be at most `capacity`. Only the first entries.size() rows are written.
+    template <typename... Ts>
+    void fill(FeatureSet<Ts...>, const std::vector<TrainingDataEntry>& entries)
+    {
         size = entries.size();
-        is_white = new float[size];
-        outcome = new float[size];
-        score = new float[size];
-        white = new int[size * FeatureSet<Ts...>::MAX_ACTIVE_FEATURES];
-        black = new int[size * FeatureSet<Ts...>::MAX_ACTIVE_FEATURES];
-        white_values = new float[size * FeatureSet<Ts...>::MAX_ACTIVE_FEATURES];
-        black_values = new float[size * FeatureSet<Ts...>::MAX_ACTIVE_FEATURES];
-        psqt_indices = new int[size];
-        layer_stack_indices = new int[size];
 
         num_active_white_features = 0;
         num_active_black_features = 0;
-        max_active_features = FeatureSet<Ts...>::MAX_ACTIVE_FEATURES;
 
         for (std::size_t i = 0; i < size * FeatureSet<Ts...>::MAX_ACTIVE_FEATURES; ++i)
             white[i] = -1;
@@ -413,6 +422,7 @@ struct SparseBatch
     float* black_values;
     int* psqt_indices;
     int* layer_stack_indices;
+    int capacity;
 
     ~SparseBatch()
     {
@@ -429,6 +439,23 @@ struct SparseBatch
 
 private:
 
+    template <typename... Ts>
+    void allocate(FeatureSet<Ts...>, int n)
+    {
+        num_inputs = FeatureSet<Ts...>::INPUTS;
+        capacity = n;
+        is_white = new float[n];
+        outcome = new float[n];
+        score = new float[n];
+        white = new int[n * FeatureSet<Ts...>::MAX_ACTIVE_FEATURES];
+        black = new int[n * FeatureSet<Ts...>::MAX_ACTIVE_FEATURES];
+        white_values = new float[n * FeatureSet<Ts...>::MAX_ACTIVE_FEATURES];
+        black_values = new float[n * FeatureSet<Ts...>::MAX_ACTIVE_FEATURES];
+        psqt_indices = new int[n];
+        layer_stack_indices = new int[n];
+        max_active_features = FeatureSet<Ts...>::MAX_ACTIVE_FEATURES;
+    }
+
     template <typename... Ts>
     void fill_entry(FeatureSet<Ts...>, int i, const TrainingDataEntry& e)
     {
@@ -934,6 +961,87 @@ std::function<bool(const TrainingDataEntry&)> make_skip_predicate(bool filtered,
     return nullptr;
 }
 
+// Calls `f` with the FeatureSet named `feature_set`, returns false if there
+// is no such feature set.
+template <typename FuncT>
+bool visit_feature_set(std::string_view feature_set, FuncT&& f)
+{
+    if (feature_set == "HalfKP")
+        f(FeatureSet<HalfKP>{});
+    else if (feature_set == "HalfKP^")
+        f(FeatureSet<HalfKPFactorized>{});
+    else if (feature_set == "HalfKA")
+        f(FeatureSet<HalfKA>{});
+    else if (feature_set == "HalfKA^")
+        f(FeatureSet<HalfKAFactorized>{});
+    else if (feature_set == "HalfKAv2")
+        f(FeatureSet<HalfKAv2>{});
+    else if (feature_set == "HalfKAv2^")
+        f(FeatureSet<HalfKAv2Factorized>{});
+    else if (feature_set == "HalfKAv2_hm")
+        f(FeatureSet<HalfKAv2_hm>{});
+    else if (feature_set == "HalfKAv2_hm^")
+        f(FeatureSet<HalfKAv2_hmFactorized>{});
+    else
+        return false;
+    return true;
+}
+
+// Refills `batch` with `size` positions given by `position_at(i)`. Scores,
+// plies and results are zero, as only the features are needed for evaluation.
+template <typename FuncT>
+bool fill_sparse_batch(const char* feature_set_c, SparseBatch* batch, int size, FuncT&& position_at)
+{
+    if (size > batch->capacity)
+    {
+        fprintf(stderr, "Too many positions for the batch: %d > %d\n", size, batch->capacity);
+        return false;
+    }
+
+    thread_local std::vector<TrainingDataEntry> entries;
+    entries.resize(size);
+    for (int i = 0; i < size; ++i)
+    {
+        auto& e = entries[i];
+        e.pos = position_at(i);
+        e.score = 0;
+        e.ply = 0;
+        e.result = 0;
+    }
+
+    if (!visit_feature_set(feature_set_c, [&](auto feature_set) {
+        batch->fill(feature_set, entries);
+    }))
+    {
+        fprintf(stderr, "Unknown feature_set %s\n", feature_set_c);
+        return false;
+    }
+    return true;
+}
+
+// White pieces, black pieces, pawns, knights, bishops, rooks and queens, the
+// bitboards of a position taken by the *_from_bitboards entry points. Kings
+// are given by their squares instead.
+static constexpr int NUM_PACKED_BITBOARDS = 7;
+
+Position position_from_bitboards(const std::uint64_t* bitboards, bool white_to_move, const int* king_squares)
+{
+    Position pos;
+    for (Color color : { Color::White, Color::Black })
+    {
+        const std::uint64_t occupied = bitboards[static_cast<int>(color)];
+        for (int pt = 0; pt < NUM_PACKED_BITBOARDS - 2; ++pt)
+        {
+            const Piece piece(static_cast<PieceType>(pt), color);
+            for (Square sq : Bitboard::fromBits(occupied & bitboards[2 + pt]))
+                pos.place(piece, sq);
+        }
+        pos.place(Piece(PieceType::King, color), Square(king_squares[static_cast<int>(color)]));
+    }
+    pos.setSideToMove(white_to_move ? Color::White : Color::Black);
+    return pos;
+}
+
 extern "C" {
 
     EXPORT SparseBatch* get_sparse_batch_from_fens(
@@ -994,6 +1102,78 @@ extern "C" {
         return nullptr;
     }
 
+    // changing the signature needs matching changes in nnue_dataset.py
+    EXPORT SparseBatch* CDECL create_sparse_batch(const char* feature_set_c, int capacity)
+    {
+        SparseBatch* batch = nullptr;
+        if (!visit_feature_set(feature_set_c, [&](auto feature_set) {
+            batch = new SparseBatch(feature_set, capacity);
+        }))
+        {
+            fprintf(stderr, "Unknown feature_set %s\n", feature_set_c);
+        }
+        return batch;
+    }
+
+    // Refills a batch made by create_sparse_batch for the same feature set,
+    // without allocating. Scores, plies and results are zero, as only the
+    // features are needed for evaluation.
+    // changing the signature needs matching changes in nnue_dataset.py
+    EXPORT bool CDECL fill_sparse_batch_from_fens(
+        const char* feature_set_c,
+        SparseBatch* batch,
+        int num_fens,
+        const char* const* fens
+    )
+    {
+        return fill_sparse_batch(feature_set_c, batch, num_fens, [&](int i) {
+            return Position::fromFen(fens[i]);
+        });
+    }
+
+    // Refills a batch made by create_sparse_batch straight from the pieces of
+    // `num_positions` positions, without going through FENs. For each
+    // position `bitboards` holds the NUM_PACKED_BITBOARDS bitboards,
+    // `king_squares` the squares of the white and black kings, and
+    // `sides_to_move` is 1 when white is to move.
+    // changing the signature needs matching changes in nnue_dataset.py
+    EXPORT bool CDECL fill_sparse_batch_from_bitboards(
+        const char* feature_set_c,
+        SparseBatch* batch,
+        int num_positions,
+        const std::uint64_t* bitboards,
+        const int* sides_to_move,
+        const int* king_squares
+    )
+    {
+        return fill_sparse_batch(feature_set_c, batch, num_positions, [&](int i) {
+            return position_from_bitboards(
+                bitboards + i * NUM_PACKED_BITBOARDS,
+                sides_to_move[i] != 0,
+                king_squares + i * 2);
+        });
+    }
+
+    // A new batch of `num_positions` positions, from the same inputs as
+    // fill_sparse_batch_from_bitboards.
+    // changing the signature needs matching changes in nnue_dataset.py
+    EXPORT SparseBatch* CDECL get_sparse_batch_from_bitboards(
+        const char* feature_set_c,
+        int num_positions,
+        const std::uint64_t* bitboards,
+        const int* sides_to_move,
+        const int* king_squares
+    )
+    {
+        SparseBatch* batch = create_sparse_batch(feature_set_c, num_positions);
+        if (batch != nullptr && !fill_sparse_batch_from_bitboards(feature_set_c, batch, num_positions, bitboards, sides_to_move, king_squares))
+        {
+            delete batch;
+            return nullptr;
+        }
+        return batch;
+    }
+
     // changing the signature needs matching changes in nnue_dataset.py
     EXPORT FenBatchStream* CDECL create_fen_batch_stream(int concurrency, const char* filename, int batch_size, bool cyclic, bool filtered, int random_fen_skipping, bool wld_filtered, int early_fen_skipping, int param_index)
     {
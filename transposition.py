@@ -0,0 +1,80 @@
+"""
+Transposition table for the alpha-beta search in app.py.
+
+Positions are keyed by their polyglot Zobrist hash, see
+https://www.chessprogramming.org/Transposition_Table
+"""
+
+import collections
+
+import chess.polyglot
+
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+DEFAULT_SIZE = 1 << 18
+
+TTEntry = collections.namedtuple(
+    "TTEntry", ["key", "depth", "score", "bound", "move", "generation"]
+)
+
+
+def position_key(board):
+    return chess.polyglot.zobrist_hash(board)
+
+
+class TranspositionTable:
+    """
+    A fixed size, direct-mapped table of search results.
+
+    A slot is replaced when it is empty, holds the same position, was
+    written during an earlier search or holds a shallower result than the
+    new one. Otherwise the deeper result from the current search is kept.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.size = size
+        self.entries = [None] * size
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def new_search(self):
+        """
+        Mark the start of a new search, entries from previous searches
+        become the first candidates for replacement.
+        """
+        self.generation += 1
+
+    def clear(self):
+        self.entries = [None] * self.size
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def probe(self, key):
+        entry = self.entries[key % self.size]
+        if entry is not None and entry.key == key:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        return None
+
+    def store(self, key, depth, score, bound, move):
+        index = key % self.size
+        entry = self.entries[index]
+        if (
+            entry is None
+            or entry.key == key
+            or entry.generation != self.generation
+            or depth >= entry.depth
+        ):
+            self.entries[index] = TTEntry(
+                key, depth, score, bound, move, self.generation
+            )
+
+    def hit_rate(self):
+        probes = self.hits + self.misses
+        return self.hits / probes if probes else 0.0
@@ -1,19 +1,64 @@
 import app as va
+import batch_evaluator
+import opening_book
+import ponder
 
 import argparse
+import asyncio
+import collections
 from chess import Board
 import chess
 import chess.svg
 import pynecone as pc
 import tempfile
+import threading
 
 BOARD_SVG_SIZE = 500
 STARTING_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
 EVAL_DEPTH = 3
+BOOK_PATH = "./data/book.bin"
 
 model = va.read_model("./data/nn-6877cd24400e.nnue")
 model.eval()
-model.cuda()
+model.to(va.default_device())
+book = opening_book.OpeningBook(BOOK_PATH)
+
+# The searches of concurrent sessions share forward passes
+evaluator = batch_evaluator.BatchEvaluator(model)
+
+def search(fen, limits=None):
+    return va.eval_position_with_search(
+        model, fen, depth=EVAL_DEPTH, book=book, limits=limits, evaluator=evaluator
+    )
+
+# The ponderer of each session, by session token, which searches our
+# answer to the user's expected move while they think. Sessions may end
+# without a reset, so only the most recently used ponderers are kept.
+MAX_PONDERERS = 64
+ponderers = collections.OrderedDict()
+ponderers_lock = threading.Lock()
+
+def get_ponderer(token):
+    with ponderers_lock:
+        if token not in ponderers:
+            ponderers[token] = ponder.Ponderer(search)
+        ponderers.move_to_end(token)
+        evicted = []
+        while len(ponderers) > MAX_PONDERERS:
+            evicted.append(ponderers.popitem(last=False)[1])
+        ponderer = ponderers[token]
+    for p in evicted:
+        p.stop()
+    return ponderer
+
+def drop_ponderer(token):
+    """
+    Stop and forget the ponderer of a session whose game is over.
+    """
+    with ponderers_lock:
+        ponderer = ponderers.pop(token, None)
+    if ponderer is not None:
+        ponderer.stop()
 
 def render_board(fen):
     board = Board(fen)
@@ -48,12 +93,13 @@ class State(pc.State):
         try:
             move = board.push_san(self.input_move)
             self.set_fen(board.fen())
-
-            self.make_computer_move()
             self.input_move = ""
         except chess.IllegalMoveError:
             self.made_illegal_move = True
             self.input_move = ""
+            return
+
+        return State.make_computer_move
 
 
     def set_fen(self, fen):
@@ -71,21 +117,33 @@ class State(pc.State):
 
     def on_key_down(self, key):
         if key == "Enter":
-            self.commit_move()
+            return self.commit_move()
         elif key == "Backspace":
             self.input_move = self.input_move[:-1]
 
 
-    def make_computer_move(self):
-        if not self.check_checkmate():
-            self.computer_thinking = True
-            _, next_move = va.eval_position_with_search(model, self.fen, depth=EVAL_DEPTH)
-            self.computer_thinking = False
-            move = next_move[0]
-            board = Board(self.fen)
-            board.push(move)
-
-            self.set_fen(board.fen())
+    async def make_computer_move(self):
+        if self.check_checkmate():
+            drop_ponderer(self.get_token())
+            return
+
+        # Show that the computer is thinking while the search runs on a
+        # background thread
+        self.computer_thinking = True
+        yield
+        fen = self.fen
+        ponderer = get_ponderer(self.get_token())
+        _, next_move = await asyncio.wrap_future(ponderer.take(fen))
+        self.computer_thinking = False
+        move = next_move[0]
+        board = Board(fen)
+        board.push(move)
+
+        self.set_fen(board.fen())
+        if board.is_game_over():
+            drop_ponderer(self.get_token())
+        else:
+            ponderer.start(fen, next_move)
 
     
     def set_move(self, s):
@@ -95,6 +153,7 @@ class State(pc.State):
         self.board_svg = render_board(self.fen)
 
     def reset_board(self):
+        drop_ponderer(self.get_token())
         self.set_fen(STARTING_FEN)
         self.check_checkmate()
 